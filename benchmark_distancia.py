@@ -0,0 +1,62 @@
+# benchmark_distancia.py
+# Compara vazão e erro dos modelos de distância para os raios típicos do sistema
+
+import argparse
+import math
+import random
+import time
+
+from comunicacao_sistema import DISTANCE_MODELS, geodesic_distance_km
+
+# Centro de referência: Fortaleza (mesma região dos usuários de exemplo)
+CENTRO = (-3.7319, -38.5267)
+RAIOS_KM = [0.5, 1.0, 2.0, 5.0]
+
+
+def gerar_pares(raio_km: float, quantidade: int, centro=CENTRO, seed: int = 42) -> list:
+    """Gera pares de pontos separados por até raio_km, em direções aleatórias"""
+    rng = random.Random(seed)
+    pares = []
+    for _ in range(quantidade):
+        lat1 = centro[0] + rng.uniform(-0.05, 0.05)
+        lon1 = centro[1] + rng.uniform(-0.05, 0.05)
+        distancia = rng.uniform(0, raio_km)
+        direcao = rng.uniform(0, 2 * math.pi)
+        lat2 = lat1 + (distancia * math.cos(direcao)) / 110.574
+        lon2 = lon1 + (distancia * math.sin(direcao)) / (111.320 * math.cos(math.radians(lat1)))
+        pares.append((lat1, lon1, lat2, lon2))
+    return pares
+
+
+def medir(modelo, pares: list) -> float:
+    inicio = time.perf_counter()
+    for lat1, lon1, lat2, lon2 in pares:
+        modelo(lat1, lon1, lat2, lon2)
+    return len(pares) / (time.perf_counter() - inicio)
+
+
+def erro_maximo_m(modelo, pares: list, referencias: list) -> float:
+    return max(abs(modelo(*par) - ref) for par, ref in zip(pares, referencias)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos modelos de distância")
+    parser.add_argument("-n", "--pares", type=int, default=20000)
+    parser.add_argument("--latitude", type=float, default=CENTRO[0],
+                        help="latitude do centro (o erro do haversine varia com a latitude)")
+    args = parser.parse_args()
+    centro = (args.latitude, CENTRO[1])
+
+    print(f"{args.pares} pares por raio, centro em {centro}")
+    print(f"{'raio':>7} | {'modelo':>9} | {'cálculos/s':>12} | {'erro máx.':>12}")
+    for raio in RAIOS_KM:
+        pares = gerar_pares(raio, args.pares, centro)
+        referencias = [geodesic_distance_km(*par) for par in pares]
+        for nome, modelo in DISTANCE_MODELS.items():
+            vazao = medir(modelo, pares)
+            erro = erro_maximo_m(modelo, pares, referencias)
+            print(f"{raio:>5.1f}km | {nome:>9} | {vazao:>12,.0f} | {erro:>10.4f} m")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# benchmark_mom.py
+# Mede a vazão do caminho assíncrono (MOM) em cada backend de broker
+
+import argparse
+import io
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+from comunicacao_sistema import (CentralServer, User, MOMCommunication,
+                                 InProcessBroker, RabbitMQBroker)
+
+
+def run_benchmark(broker, total: int, confirm_mode: bool) -> dict:
+    """Publica total mensagens de A para B e mede publicação e entrega"""
+    central_server = CentralServer()
+    sender = User("Bench-A", -3.7319, -38.5267)
+    receiver = User("Bench-B", -3.7319, -38.5267)
+    central_server.register_user(sender)
+    central_server.register_user(receiver)
+
+    sender_mom = MOMCommunication(sender, central_server, confirm_mode=confirm_mode, broker=broker)
+    receiver_mom = MOMCommunication(receiver, central_server, broker=broker)
+
+    received = [0]
+    done = threading.Event()
+
+    def on_batch(messages):
+        received[0] += len(messages)
+        if received[0] >= total:
+            done.set()
+
+    receiver_mom.set_batch_message_handler(on_batch)
+
+    with redirect_stdout(io.StringIO()):
+        if not receiver_mom.connect() or not sender_mom.connect():
+            return None
+        receiver_mom.start_consuming()
+
+        start = time.perf_counter()
+        futures = [sender_mom.publish_confirmed(receiver.id, f"mensagem {i}") for i in range(total)]
+        sender_mom.flush_confirms()
+        confirmed = sum(1 for f in futures if f.result(timeout=30))
+        published = time.perf_counter() - start
+
+        done.wait(timeout=60)
+        delivered = time.perf_counter() - start
+
+        receiver_mom.stop_consuming()
+        sender_mom.stop_consuming()
+
+    return {
+        'confirmadas': confirmed,
+        'recebidas': received[0],
+        'publicacao_msg_s': total / published,
+        'entrega_msg_s': received[0] / delivered
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos backends de broker do MOM")
+    parser.add_argument("-n", "--mensagens", type=int, default=5000)
+    parser.add_argument("--confirm", action="store_true", help="usar modo confirmado")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench_broker_")
+    backends = [("em processo", InProcessBroker(data_dir))]
+    try:
+        import pika
+        connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+        connection.close()
+        backends.append(("rabbitmq", RabbitMQBroker()))
+    except Exception as e:
+        print(f"RabbitMQ indisponível, medindo apenas o backend em processo ({e!r})")
+
+    print(f"{args.mensagens} mensagens, modo confirmado: {args.confirm}")
+    for name, broker in backends:
+        result = run_benchmark(broker, args.mensagens, args.confirm)
+        if result is None:
+            print(f"{name:>12}: falha ao conectar")
+            continue
+        print(f"{name:>12}: publicação {result['publicacao_msg_s']:,.0f} msg/s | "
+              f"entrega {result['entrega_msg_s']:,.0f} msg/s | "
+              f"confirmadas {result['confirmadas']} | recebidas {result['recebidas']}")
+
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
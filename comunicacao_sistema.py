@@ -3,6 +3,10 @@
 
 import json
 import socket
+import hmac
+import hashlib
+import os
+import tempfile
 import threading
 import time
 import math
@@ -11,11 +15,69 @@ from geopy.distance import geodesic
 from typing import Dict, List, Tuple, Optional, Callable
 import uuid
 import queue
+import heapq
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+# Modelos de distância (km). Erros medidos contra o geodésico WGS-84 em
+# benchmark_distancia.py, para os raios típicos do sistema (até alguns km):
+# - geodesic: elipsoide WGS-84 (geopy/Karney), exato na prática (nanômetros);
+#   é o mais lento.
+# - haversine: esfera de raio médio 6371,0088 km; erro relativo de até ~0,56%
+#   (5,6 m em 1 km no equador), dependendo da latitude e da direção; ~100x
+#   mais rápido que o geodésico.
+# - planar: projeção local com os raios de curvatura do WGS-84 na latitude
+#   média; erro abaixo de 1 cm até 5 km, crescendo com o cubo da
+#   distância (não usar para centenas de km nem perto dos polos).
+_WGS84_A = 6378137.0
+_WGS84_E2 = (1 / 298.257223563) * (2 - 1 / 298.257223563)
+_MEAN_EARTH_RADIUS_KM = 6371.0088
+
+
+def geodesic_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    return geodesic((lat1, lon1), (lat2, lon2)).kilometers
+
+
+def haversine_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    h = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * _MEAN_EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+
+def planar_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi_m = math.radians((lat1 + lat2) / 2)
+    sin2 = math.sin(phi_m) ** 2
+    w = 1 - _WGS84_E2 * sin2
+    prime_vertical = _WGS84_A / math.sqrt(w)
+    meridional = _WGS84_A * (1 - _WGS84_E2) / (w * math.sqrt(w))
+    dlambda = (lon2 - lon1 + 180.0) % 360.0 - 180.0
+    dx = prime_vertical * math.cos(phi_m) * math.radians(dlambda)
+    dy = meridional * math.radians(lat2 - lat1)
+    return math.hypot(dx, dy) / 1000.0
+
+
+DISTANCE_MODELS: Dict[str, Callable[[float, float, float, float], float]] = {
+    'geodesic': geodesic_distance_km,
+    'haversine': haversine_distance_km,
+    'planar': planar_distance_km
+}
+
+
+def get_distance_model(name: str) -> Callable[[float, float, float, float], float]:
+    if name not in DISTANCE_MODELS:
+        raise ValueError(f"Modelo de distância desconhecido: {name} (use {', '.join(DISTANCE_MODELS)})")
+    return DISTANCE_MODELS[name]
 
 
 class User:
     def __init__(self, name: str, latitude: float, longitude: float,
-                 communication_radius: float = 1.0):
+                 communication_radius: float = 1.0, distance_model: str = 'geodesic',
+                 max_contacts: Optional[int] = None):
         self.id = str(uuid.uuid4())
         self.name = name
         self.latitude = latitude
@@ -23,8 +85,21 @@ class User:
         self.communication_radius = communication_radius
         self.status = "offline"
         self.contacts = []
+        # Distância (km) até cada contato, calculada junto com a lista de contatos
+        self.contact_distances: Dict[str, float] = {}
+        # Visão pronta dos contatos (nome, status, distância, alcance), trocada
+        # por inteiro pelo CentralServer para permitir leitura sem lock
+        self.contact_snapshot: tuple = ()
         self.socket_port = None
         self.rpc_port = None
+        # Limite opcional de contatos: apenas os max_contacts mais próximos no alcance
+        self.max_contacts = max_contacts
+        self.distance_model = distance_model
+        self._distance = get_distance_model(distance_model)
+
+    def set_distance_model(self, distance_model: str):
+        self._distance = get_distance_model(distance_model)
+        self.distance_model = distance_model
 
     def to_dict(self):
         return {
@@ -36,7 +111,8 @@ class User:
             'status': self.status,
             'contacts': self.contacts,
             'socket_port': self.socket_port,
-            'rpc_port': self.rpc_port
+            'rpc_port': self.rpc_port,
+            'max_contacts': self.max_contacts
         }
 
     def update_location(self, latitude: float, longitude: float):
@@ -54,45 +130,297 @@ class User:
             self.contacts.append(user_id)
 
     def distance_to(self, other_user) -> float:
-        return geodesic(
-            (self.latitude, self.longitude),
-            (other_user.latitude, other_user.longitude)
-        ).kilometers
+        return self._distance(self.latitude, self.longitude, other_user.latitude, other_user.longitude)
 
     def is_in_communication_range(self, other_user) -> bool:
         distance = self.distance_to(other_user)
         return distance <= self.communication_radius
 
 
+class SpatialGridIndex:
+    """Índice espacial em grade uniforme de latitude/longitude.
+
+    Cada usuário fica na célula que contém suas coordenadas; uma consulta por
+    raio visita só as células que cobrem o círculo, então o custo depende da
+    densidade local e não do total de usuários. As células têm cell_size_km
+    no sentido norte-sul (e menos no leste-oeste, fora do equador). Consultas
+    que cruzam o antimeridiano (±180°) não são suportadas.
+    """
+
+    # Quilômetros por grau usados como limites inferiores, válidos para todos
+    # os modelos de distância: arco meridiano mínimo do WGS-84 (latitude) e
+    # grau do equador na esfera média, menor que no elipsoide (longitude)
+    KM_PER_DEG_LAT = 110.574
+    KM_PER_DEG_LON = 111.195
+
+    def __init__(self, cell_size_km: float = 1.0):
+        self.cell_size_km = cell_size_km
+        self.cell_deg = cell_size_km / self.KM_PER_DEG_LAT
+        self.cells: Dict[Tuple[int, int], set] = {}
+        self.positions: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell_of(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(latitude / self.cell_deg), math.floor(longitude / self.cell_deg)
+
+    def insert(self, user_id: str, latitude: float, longitude: float):
+        """Insere ou move o usuário para a célula das coordenadas"""
+        cell = self.cell_of(latitude, longitude)
+        old_cell = self.positions.get(user_id)
+        if old_cell == cell:
+            return
+        if old_cell is not None:
+            self._discard(user_id, old_cell)
+        self.cells.setdefault(cell, set()).add(user_id)
+        self.positions[user_id] = cell
+
+    def remove(self, user_id: str):
+        cell = self.positions.pop(user_id, None)
+        if cell is not None:
+            self._discard(user_id, cell)
+
+    def _discard(self, user_id: str, cell: Tuple[int, int]):
+        members = self.cells[cell]
+        members.discard(user_id)
+        if not members:
+            del self.cells[cell]
+
+    def cell_span(self, latitude: float, radius_km: float) -> Tuple[int, int]:
+        """Quantas células (linhas, colunas) a partir do centro cobrem o raio"""
+        lat_deg = radius_km / self.KM_PER_DEG_LAT
+        extreme_lat = min(90.0, abs(latitude) + lat_deg)
+        cos_lat = math.cos(math.radians(extreme_lat))
+        lon_deg = 180.0 if cos_lat < 1e-9 else min(180.0, radius_km / (self.KM_PER_DEG_LON * cos_lat))
+        return math.ceil(lat_deg / self.cell_deg) + 1, math.ceil(lon_deg / self.cell_deg) + 1
+
+    def candidates(self, latitude: float, longitude: float, radius_km: float):
+        """IDs nas células que cobrem o círculo; a distância exata fica com o chamador"""
+        rows, cols = self.cell_span(latitude, radius_km)
+        # Círculo maior que a área ocupada: percorrer as células existentes sai mais barato
+        if (2 * rows + 1) * (2 * cols + 1) >= len(self.cells):
+            for members in self.cells.values():
+                yield from members
+            return
+
+        center_row, center_col = self.cell_of(latitude, longitude)
+        for row in range(center_row - rows, center_row + rows + 1):
+            for col in range(center_col - cols, center_col + cols + 1):
+                members = self.cells.get((row, col))
+                if members:
+                    yield from members
+
+    def nearest(self, latitude: float, longitude: float, k: int, distance_of: Callable[[str], float],
+                max_km: float = None, exclude: str = None) -> List[Tuple[float, str]]:
+        """Os k IDs mais próximos do ponto, como (distância, id) em ordem crescente.
+
+        Busca best-first em anéis de células a partir da célula do ponto,
+        mantendo os k melhores num heap; para assim que nenhuma célula fora
+        dos anéis visitados pode conter algo mais próximo que o k-ésimo."""
+        if k <= 0 or not self.positions:
+            return []
+        best = []  # heap máximo via distâncias negativas
+        limit = max_km if max_km is not None else math.inf
+        center_row, center_col = self.cell_of(latitude, longitude)
+
+        def consider(members):
+            for user_id in members:
+                if user_id == exclude:
+                    continue
+                distance = distance_of(user_id)
+                if distance > limit:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, user_id))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, user_id))
+
+        ring = 0
+        while True:
+            # Anéis já maiores que a área ocupada: visitar as células restantes
+            if (2 * ring + 1) ** 2 >= len(self.cells):
+                for (row, col), members in self.cells.items():
+                    if max(abs(row - center_row), abs(col - center_col)) >= ring:
+                        consider(members)
+                break
+
+            for cell in self._ring_cells(center_row, center_col, ring):
+                members = self.cells.get(cell)
+                if members:
+                    consider(members)
+
+            threshold = -best[0][0] if len(best) == k else limit
+            if self._outside_lower_bound(latitude, longitude, center_row, center_col, ring, threshold) >= threshold:
+                break
+            ring += 1
+
+        return sorted((-negative, user_id) for negative, user_id in best)
+
+    @staticmethod
+    def _ring_cells(center_row: int, center_col: int, ring: int):
+        if ring == 0:
+            yield center_row, center_col
+            return
+        for col in range(center_col - ring, center_col + ring + 1):
+            yield center_row - ring, col
+            yield center_row + ring, col
+        for row in range(center_row - ring + 1, center_row + ring):
+            yield row, center_col - ring
+            yield row, center_col + ring
+
+    def _outside_lower_bound(self, latitude: float, longitude: float, center_row: int, center_col: int,
+                             ring: int, threshold: float) -> float:
+        """Distância mínima (km) do ponto a qualquer posição fora dos anéis visitados"""
+        if math.isinf(threshold):
+            return 0.0
+        north = (center_row + ring + 1) * self.cell_deg - latitude
+        south = latitude - (center_row - ring) * self.cell_deg
+        east = (center_col + ring + 1) * self.cell_deg - longitude
+        west = longitude - (center_col - ring) * self.cell_deg
+        # Um caminho mais curto que threshold não sai desta faixa de latitude
+        band = min(90.0, abs(latitude) + threshold / self.KM_PER_DEG_LAT)
+        lon_km_per_deg = self.KM_PER_DEG_LON * math.cos(math.radians(band))
+        return min(min(north, south) * self.KM_PER_DEG_LAT, min(east, west) * lon_km_per_deg)
+
+
 class CentralServer:
-    def __init__(self):
+    def __init__(self, movement_threshold_m: float = 5.0, location_debounce: float = 0.0,
+                 distance_model: str = 'geodesic', index_cell_km: float = 1.0):
         self.users: Dict[str, User] = {}
+        # Índice espacial usado no cálculo de contatos e nas consultas por área
+        self.spatial_index = SpatialGridIndex(index_cell_km)
+        # Modelo usado no cálculo de contatos (ver DISTANCE_MODELS)
+        self.distance_model = distance_model
+        self._distance = get_distance_model(distance_model)
         self.lock = threading.Lock()
+        # Versão do diretório: muda sempre que coordenadas ou raios mudam,
+        # invalidando os tokens de alcance emitidos antes da mudança
+        self.directory_version = 0
+        self._token_secret = os.urandom(32)
+        # Assinantes de mudanças de contatos: user_id -> callbacks(events).
+        # Os eventos são gerados sob o lock e entregues, em ordem, por uma
+        # thread própria, fora do lock
+        self.subscribers: Dict[str, List[Callable]] = {}
+        self.event_queue = queue.SimpleQueue()
+        self.event_thread = None
+        # Deslocamentos menores que movement_threshold_m (ruído de GPS) só
+        # atualizam as coordenadas; com location_debounce > 0, atualizações
+        # seguidas do mesmo usuário geram no máximo um recálculo por janela
+        self.movement_threshold_m = movement_threshold_m
+        self.location_debounce = location_debounce
+        self.computed_locations: Dict[str, Tuple[float, float]] = {}
+        self.last_location_recompute: Dict[str, float] = {}
+        self.location_timers: Dict[str, threading.Timer] = {}
 
     def register_user(self, user: User) -> bool:
         with self.lock:
             if user.id not in self.users:
                 self.users[user.id] = user
-                self._update_contacts_for_all()
+                self.spatial_index.insert(user.id, user.latitude, user.longitude)
+                self.directory_version += 1
+                self._emit(self._update_contacts_for_all())
                 return True
             return False
 
     def update_user_location(self, user_id: str, latitude: float, longitude: float):
         with self.lock:
-            if user_id in self.users:
-                self.users[user_id].update_location(latitude, longitude)
-                self._update_contacts_for_all()
+            user = self.users.get(user_id)
+            if not user:
+                return
+            user.update_location(latitude, longitude)
+            # O índice sempre acompanha a posição armazenada, mesmo sem recálculo
+            self.spatial_index.insert(user_id, latitude, longitude)
+            if not self._moved_enough(user):
+                return
+
+            if self.location_debounce > 0:
+                if user_id in self.location_timers:
+                    return  # O recálculo ao fim da janela usará a posição mais recente
+                wait = (self.last_location_recompute.get(user_id, float('-inf')) +
+                        self.location_debounce - time.monotonic())
+                if wait > 0:
+                    timer = threading.Timer(wait, self._apply_pending_location, args=(user_id,))
+                    timer.daemon = True
+                    self.location_timers[user_id] = timer
+                    timer.start()
+                    return
+
+            self._recompute_location(user)
+
+    def _moved_enough(self, user: User) -> bool:
+        last = self.computed_locations.get(user.id)
+        if last is None or self.movement_threshold_m <= 0:
+            return True
+        return self._distance(last[0], last[1], user.latitude, user.longitude) * 1000 >= self.movement_threshold_m
+
+    def _recompute_location(self, user: User):
+        # Chamado com self.lock adquirido
+        self.last_location_recompute[user.id] = time.monotonic()
+        self.directory_version += 1
+        self._emit(self._update_contacts_for_all())
+
+    def _apply_pending_location(self, user_id: str):
+        with self.lock:
+            self.location_timers.pop(user_id, None)
+            user = self.users.get(user_id)
+            # Um recálculo de outro usuário pode já ter incluído a nova posição
+            if user and self._moved_enough(user):
+                self._recompute_location(user)
 
     def update_user_status(self, user_id: str, status: str):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                # O chamador costuma alterar o próprio objeto User antes, então
+                # o evento é emitido mesmo sem diferença aparente de status
+                user.set_status(status)
+                for other_user in self.users.values():
+                    if user.id in other_user.contact_distances:
+                        self._refresh_contact_snapshot(other_user)
+                self._emit(self._status_events(user))
+
+    def update_user_max_contacts(self, user_id: str, max_contacts: Optional[int]):
+        """Limita o usuário aos max_contacts contatos mais próximos (None remove o limite)"""
         with self.lock:
             if user_id in self.users:
-                self.users[user_id].set_status(status)
+                self.users[user_id].max_contacts = max_contacts
+                self._emit(self._update_contacts_for_all())
 
     def update_user_radius(self, user_id: str, radius: float):
         with self.lock:
             if user_id in self.users:
                 self.users[user_id].update_radius(radius)
-                self._update_contacts_for_all()
+                self.directory_version += 1
+                self._emit(self._update_contacts_for_all())
+
+    def subscribe(self, user_id: str, callback: Callable):
+        """Registra callback(events) para as mudanças nos contatos de user_id.
+
+        Cada evento é um dict com type ('added', 'removed', 'online',
+        'offline' ou 'distance_changed'), contact_id, name, status e distance."""
+        with self.lock:
+            self.subscribers.setdefault(user_id, []).append(callback)
+            if self.event_thread is None:
+                self.event_thread = threading.Thread(target=self._event_loop, name="contact-events")
+                self.event_thread.daemon = True
+                self.event_thread.start()
+
+    def unsubscribe(self, user_id: str, callback: Callable):
+        with self.lock:
+            callbacks = self.subscribers.get(user_id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.subscribers.pop(user_id, None)
+
+    def update_user_endpoints(self, user_id: str, socket_port: Optional[int], rpc_port: Optional[int]):
+        """Publica as portas efetivamente atribuídas aos serviços do usuário"""
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                user.socket_port = socket_port
+                user.rpc_port = rpc_port
 
     def get_user(self, user_id: str) -> Optional[User]:
         with self.lock:
@@ -102,14 +430,210 @@ class CentralServer:
         with self.lock:
             return self.users.copy()
 
-    def _update_contacts_for_all(self):
-        user_list = list(self.users.values())
-        for user in user_list:
-            new_contacts = []
-            for other_user in user_list:
-                if user.id != other_user.id and user.is_in_communication_range(other_user):
-                    new_contacts.append(other_user.id)
-            user.contacts = new_contacts
+    def query_radius(self, latitude: float, longitude: float, radius_km: float,
+                     status_filter: str = None) -> List[Tuple[User, float]]:
+        """Usuários a até radius_km do ponto, como (usuário, distância em km), do mais próximo ao mais distante"""
+        with self.lock:
+            results = self._within(latitude, longitude, radius_km, status_filter)
+        results.sort(key=lambda item: item[1])
+        return results
+
+    def nearest(self, user_id: str, k: int, max_km: float = None) -> List[Tuple[User, float]]:
+        """Os k usuários mais próximos de user_id, como (usuário, distância em km), em ordem crescente"""
+        with self.lock:
+            user = self.users.get(user_id)
+            if not user:
+                return []
+            return self._nearest(user.latitude, user.longitude, k, max_km, exclude=user_id)
+
+    def _nearest(self, latitude: float, longitude: float, k: int, max_km: float = None,
+                 exclude: str = None) -> List[Tuple[User, float]]:
+        # Chamado com self.lock adquirido
+        def distance_of(user_id: str) -> float:
+            other_user = self.users[user_id]
+            return self._distance(latitude, longitude, other_user.latitude, other_user.longitude)
+
+        return [(self.users[user_id], distance) for distance, user_id in
+                self.spatial_index.nearest(latitude, longitude, k, distance_of, max_km, exclude)]
+
+    def _within(self, latitude: float, longitude: float, radius_km: float,
+                status_filter: str = None) -> List[Tuple[User, float]]:
+        # Chamado com self.lock adquirido
+        results = []
+        for user_id in self.spatial_index.candidates(latitude, longitude, radius_km):
+            user = self.users[user_id]
+            if status_filter and user.status != status_filter:
+                continue
+            distance = self._distance(latitude, longitude, user.latitude, user.longitude)
+            if distance <= radius_km:
+                results.append((user, distance))
+        return results
+
+    def issue_range_token(self, sender_id: str, target_id: str) -> Optional[dict]:
+        """Gera token assinado se o destino estiver no alcance do remetente.
+
+        A distância é calculada aqui, com as posições registradas e o modelo
+        de distância do servidor; fora do alcance, nenhum token é emitido."""
+        with self.lock:
+            sender = self.users.get(sender_id)
+            target = self.users.get(target_id)
+            if not sender or not target:
+                return None
+            distance = self._distance(sender.latitude, sender.longitude, target.latitude, target.longitude)
+            if distance > sender.communication_radius:
+                return None
+            token = {
+                'sender_id': sender.id,
+                'sender_name': sender.name,
+                'target_id': target.id,
+                'version': self.directory_version,
+                'distance': distance,
+                'radius': sender.communication_radius
+            }
+        token['signature'] = self._sign_range_token(token)
+        return token
+
+    def verify_range_token(self, token: dict, sender_id: str, target_id: str) -> bool:
+        """Valida o token sem consultar o diretório; falha se a versão mudou"""
+        try:
+            if token['sender_id'] != sender_id or token['target_id'] != target_id:
+                return False
+            if token['version'] != self.directory_version:
+                return False
+            if not hmac.compare_digest(token['signature'], self._sign_range_token(token)):
+                return False
+            return token['distance'] <= token['radius']
+        except (KeyError, TypeError):
+            return False
+
+    def _sign_range_token(self, token: dict) -> str:
+        payload = f"{token['sender_id']}|{token['sender_name']}|{token['target_id']}|" \
+                  f"{token['version']}|{token['distance']!r}|{token['radius']!r}"
+        return hmac.new(self._token_secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def _update_contacts_for_all(self) -> List[Tuple[str, dict]]:
+        """Recalcula contatos e distâncias; retorna os eventos dos assinantes"""
+        events = []
+        for user in self.users.values():
+            self.computed_locations[user.id] = (user.latitude, user.longitude)
+            # Só os usuários das células que cobrem o raio são avaliados
+            if user.max_contacts:
+                in_range = self._nearest(user.latitude, user.longitude, user.max_contacts,
+                                         user.communication_radius, exclude=user.id)
+            else:
+                in_range = sorted(self._within(user.latitude, user.longitude, user.communication_radius),
+                                  key=lambda item: item[1])
+            new_distances = {other_user.id: distance for other_user, distance in in_range
+                             if other_user.id != user.id}
+            old_distances = user.contact_distances
+            user.contacts = list(new_distances)
+            user.contact_distances = new_distances
+            self._refresh_contact_snapshot(user)
+            if user.id in self.subscribers:
+                events.extend(self._contact_diff(user, old_distances, new_distances))
+        return events
+
+    def _refresh_contact_snapshot(self, user: User):
+        user.contact_snapshot = tuple(
+            {
+                'name': self.users[contact_id].name,
+                'id': contact_id,
+                'status': self.users[contact_id].status,
+                'distance': round(distance, 2),
+                'in_range': distance <= user.communication_radius
+            }
+            for contact_id, distance in user.contact_distances.items()
+        )
+
+    def _contact_diff(self, user: User, old: Dict[str, float], new: Dict[str, float]) -> List[Tuple[str, dict]]:
+        events = []
+        for contact_id, distance in new.items():
+            if contact_id not in old:
+                events.append((user.id, self._contact_event('added', self.users[contact_id], distance)))
+            elif distance != old[contact_id]:
+                events.append((user.id, self._contact_event('distance_changed', self.users[contact_id], distance)))
+        for contact_id in old:
+            if contact_id not in new:
+                events.append((user.id, self._contact_event('removed', self.users[contact_id], None)))
+        return events
+
+    def _status_events(self, contact: User) -> List[Tuple[str, dict]]:
+        # Apenas assinantes que têm o usuário como contato são notificados
+        return [(user_id, self._contact_event(contact.status, contact,
+                                              self.users[user_id].contact_distances[contact.id]))
+                for user_id in self.subscribers
+                if user_id in self.users and contact.id in self.users[user_id].contact_distances]
+
+    @staticmethod
+    def _contact_event(event_type: str, contact: User, distance: Optional[float]) -> dict:
+        return {
+            'type': event_type,
+            'contact_id': contact.id,
+            'name': contact.name,
+            'status': contact.status,
+            'distance': distance
+        }
+
+    def _emit(self, events: List[Tuple[str, dict]]):
+        # Chamado com self.lock adquirido: a fila preserva a ordem das mudanças
+        if events:
+            self.event_queue.put(events)
+
+    def _event_loop(self):
+        while True:
+            events = self.event_queue.get()
+            by_user: Dict[str, List[dict]] = {}
+            for user_id, event in events:
+                by_user.setdefault(user_id, []).append(event)
+
+            for user_id, user_events in by_user.items():
+                with self.lock:
+                    callbacks = list(self.subscribers.get(user_id, []))
+                for callback in callbacks:
+                    try:
+                        callback(user_events)
+                    except Exception as e:
+                        print(f"Erro em assinante de contatos: {e}")
+
+
+class PortAllocator:
+    """Distribui portas livres de um intervalo fixo (por exemplo, o liberado no firewall).
+
+    Sem alocador, os serviços usam a porta 0 e o sistema operacional escolhe
+    uma porta efêmera livre."""
+
+    def __init__(self, start: int, end: int, host: str = 'localhost'):
+        self.start = start
+        self.end = end
+        self.host = host
+        self.allocated = set()
+        self.next_port = start
+        self.lock = threading.Lock()
+
+    def allocate(self) -> int:
+        with self.lock:
+            for _ in range(self.end - self.start + 1):
+                port = self.next_port
+                self.next_port = self.start if port >= self.end else port + 1
+                if port not in self.allocated and self._is_free(port):
+                    self.allocated.add(port)
+                    return port
+        raise RuntimeError(f"Nenhuma porta livre entre {self.start} e {self.end}")
+
+    def release(self, port: int):
+        with self.lock:
+            self.allocated.discard(port)
+
+    def _is_free(self, port: int) -> bool:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind((self.host, port))
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
 
 
 class SocketCommunicationServer:
@@ -121,14 +645,16 @@ class SocketCommunicationServer:
         self.message_handler = None  # Handler para mensagens recebidas
 
     def set_message_handler(self, handler: Callable):
-        """Define handler para processar mensagens recebidas"""
+        """Define handler(sender, message, msg_type, message_id, sender_id) para mensagens recebidas"""
         self.message_handler = handler
 
-    def start_server(self, port: int):
-        self.user.socket_port = port
+    def start_server(self, port: int = 0) -> int:
+        """Inicia o servidor; com port = 0 o sistema escolhe a porta. Retorna a porta efetiva"""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(('localhost', port))
+        port = self.server_socket.getsockname()[1]
+        self.user.socket_port = port
         self.server_socket.listen(5)
         self.running = True
 
@@ -137,6 +663,7 @@ class SocketCommunicationServer:
         thread.start()
 
         print(f"Servidor socket iniciado na porta {port} para {self.user.name}")
+        return port
 
     def _accept_connections(self):
         while self.running:
@@ -152,11 +679,28 @@ class SocketCommunicationServer:
             except:
                 break
 
+    @staticmethod
+    def _recv_line(sock) -> str:
+        """Lê do socket até o delimitador de fim de mensagem (\\n) ou EOF"""
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                break
+        return b''.join(chunks).decode('utf-8')
+
     def _handle_client(self, client_socket):
         try:
-            data = client_socket.recv(1024).decode('utf-8')
+            data = self._recv_line(client_socket)
             message_data = json.loads(data)
 
+            if message_data.get('type') == 'batch':
+                self._handle_batch(client_socket, message_data)
+                return
+
             response = {
                 'status': 'received',
                 'timestamp': datetime.now().isoformat(),
@@ -169,20 +713,67 @@ class SocketCommunicationServer:
                 self.message_handler(
                     message_data.get('sender', 'Desconhecido'),
                     message_data.get('message', ''),
-                    'socket'
+                    'socket',
+                    message_data.get('message_id'),
+                    message_data.get('sender_id')
                 )
             else:
                 # Fallback para console
                 print(f"\n[MENSAGEM SÍNCRONA] {message_data.get('sender', 'Desconhecido')} -> {self.user.name}")
                 print(f"Conteúdo: {message_data.get('message', '')}")
 
-            client_socket.send(json.dumps(response).encode('utf-8'))
+            client_socket.sendall(json.dumps(response).encode('utf-8'))
         except Exception as e:
             print(f"Erro ao processar mensagem socket: {e}")
         finally:
             client_socket.close()
 
-    def send_message(self, target_user_id: str, message: str) -> bool:
+    def _handle_batch(self, client_socket, batch_data):
+        """Entrega em ordem as mensagens de um lote e confirma o lote inteiro"""
+        sender = batch_data.get('sender', 'Desconhecido')
+        sender_id = batch_data.get('sender_id')
+        messages = batch_data.get('messages', [])
+        for item in messages:
+            if self.message_handler:
+                self.message_handler(sender, item.get('message', ''), 'socket', item.get('message_id'), sender_id)
+            else:
+                print(f"\n[MENSAGEM SÍNCRONA] {sender} -> {self.user.name}")
+                print(f"Conteúdo: {item.get('message', '')}")
+
+        response = {
+            'status': 'received',
+            'timestamp': datetime.now().isoformat(),
+            'recipient': self.user.name,
+            'count': len(messages)
+        }
+        client_socket.sendall(json.dumps(response).encode('utf-8'))
+
+    def send_message(self, target_user_id: str, message: str, message_id: str = None) -> bool:
+        message_data = {
+            'sender': self.user.name,
+            'sender_id': self.user.id,
+            'message_id': message_id,
+            'message': message,
+            'timestamp': datetime.now().isoformat(),
+            'type': 'synchronous'
+        }
+        return self._send_payload(target_user_id, message_data, "Mensagem socket")
+
+    def send_batch(self, target_user_id: str, messages: List[str], message_ids: List[str]) -> bool:
+        """Envia várias mensagens, em ordem, numa única conexão"""
+        timestamp = datetime.now().isoformat()
+        batch_data = {
+            'sender': self.user.name,
+            'sender_id': self.user.id,
+            'messages': [
+                {'message_id': message_id, 'message': message, 'timestamp': timestamp}
+                for message, message_id in zip(messages, message_ids)
+            ],
+            'type': 'batch'
+        }
+        return self._send_payload(target_user_id, batch_data, f"Lote de {len(messages)} mensagens socket")
+
+    def _send_payload(self, target_user_id: str, payload: dict, description: str) -> bool:
         target_user = self.central_server.get_user(target_user_id)
         if not target_user or target_user.socket_port is None:
             return False
@@ -196,19 +787,12 @@ class SocketCommunicationServer:
             client_socket.settimeout(5)  # Timeout de 5 segundos
             client_socket.connect(('localhost', target_user.socket_port))
 
-            message_data = {
-                'sender': self.user.name,
-                'sender_id': self.user.id,
-                'message': message,
-                'timestamp': datetime.now().isoformat(),
-                'type': 'synchronous'
-            }
-
-            client_socket.send(json.dumps(message_data).encode('utf-8'))
+            # \n delimita o fim da mensagem para o servidor
+            client_socket.sendall(json.dumps(payload).encode('utf-8') + b'\n')
             response = client_socket.recv(1024).decode('utf-8')
             client_socket.close()
 
-            print(f"Mensagem socket enviada com sucesso para {target_user.name}")
+            print(f"{description} enviada com sucesso para {target_user.name}")
             return True
 
         except Exception as e:
@@ -235,23 +819,34 @@ class RPCCommunicationService:
         self.message_handler = None
 
     def set_message_handler(self, handler: Callable):
-        """Define handler para processar mensagens recebidas"""
+        """Define handler(sender, message, msg_type, message_id, sender_id) para mensagens recebidas"""
         self.message_handler = handler
 
-    def send_synchronous_message(self, sender_id: str, message: str):
+    def _resolve_sender(self, sender_id: str, range_token: dict = None):
+        """Retorna (nome do remetente, remetente no alcance) ou (None, False)"""
+        # Token válido dispensa a consulta ao diretório e o recálculo da distância
+        if range_token and self.central_server.verify_range_token(range_token, sender_id, self.user.id):
+            return range_token['sender_name'], True
+
         sender = self.central_server.get_user(sender_id)
         if not sender:
+            return None, False
+        return sender.name, sender.is_in_communication_range(self.user)
+
+    def send_synchronous_message(self, sender_id: str, message: str, range_token: dict = None,
+                                 message_id: str = None):
+        sender_name, in_range = self._resolve_sender(sender_id, range_token)
+        if sender_name is None:
             return {'status': 'error', 'message': 'Sender not found'}
 
-        if (self.user.status == "online" and
-                sender.is_in_communication_range(self.user)):
+        if self.user.status == "online" and in_range:
 
             # Chamar handler personalizado se definido
             if self.message_handler:
-                self.message_handler(sender.name, message, 'rpc')
+                self.message_handler(sender_name, message, 'rpc', message_id, sender_id)
             else:
                 # Fallback para console
-                print(f"\n[MENSAGEM RPC] {sender.name} -> {self.user.name}")
+                print(f"\n[MENSAGEM RPC] {sender_name} -> {self.user.name}")
                 print(f"Conteúdo: {message}")
 
             return {
@@ -265,6 +860,32 @@ class RPCCommunicationService:
                 'message': 'User offline or out of range'
             }
 
+    def send_synchronous_batch(self, sender_id: str, messages: list, range_token: dict = None):
+        """Recebe um lote de pares [message_id, message] e entrega na ordem"""
+        sender_name, in_range = self._resolve_sender(sender_id, range_token)
+        if sender_name is None:
+            return {'status': 'error', 'message': 'Sender not found'}
+
+        if self.user.status != "online" or not in_range:
+            return {
+                'status': 'failed',
+                'message': 'User offline or out of range'
+            }
+
+        for message_id, message in messages:
+            if self.message_handler:
+                self.message_handler(sender_name, message, 'rpc', message_id, sender_id)
+            else:
+                print(f"\n[MENSAGEM RPC] {sender_name} -> {self.user.name}")
+                print(f"Conteúdo: {message}")
+
+        return {
+            'status': 'delivered',
+            'timestamp': datetime.now().isoformat(),
+            'recipient': self.user.name,
+            'count': len(messages)
+        }
+
     def get_user_status(self):
         return {
             'name': self.user.name,
@@ -278,13 +899,31 @@ class RPCClient:
         self.user = user
         self.central_server = central_server
 
-    def send_message_to_user(self, target_user_id: str, message: str) -> bool:
+    def send_message_to_user(self, target_user_id: str, message: str, message_id: str = None) -> bool:
+        return self._call_target(
+            target_user_id,
+            lambda rpc_service, range_token: rpc_service.send_synchronous_message(
+                self.user.id, message, range_token, message_id)
+        )
+
+    def send_batch_to_user(self, target_user_id: str, messages: List[str], message_ids: List[str]) -> bool:
+        """Envia várias mensagens, em ordem, numa única chamada RPC"""
+        batch = [[message_id, message] for message, message_id in zip(messages, message_ids)]
+        return self._call_target(
+            target_user_id,
+            lambda rpc_service, range_token: rpc_service.send_synchronous_batch(
+                self.user.id, batch, range_token)
+        )
+
+    def _call_target(self, target_user_id: str, call: Callable) -> bool:
         target_user = self.central_server.get_user(target_user_id)
-        if not target_user or not target_user.rpc_port:
+        if not target_user or not target_user.rpc_port or target_user.status != "online":
             return False
 
-        if (target_user.status != "online" or
-                not self.user.is_in_communication_range(target_user)):
+        # O servidor só emite o token com o destino no alcance; se o diretório
+        # mudar depois, a versão do token deixa de valer e ele é recusado
+        range_token = self.central_server.issue_range_token(self.user.id, target_user_id)
+        if range_token is None:
             return False
 
         try:
@@ -292,7 +931,7 @@ class RPCClient:
             rpc_service = Pyro5.api.Proxy(uri)
             rpc_service._pyroTimeout = 5  # Timeout de 5 segundos
 
-            result = rpc_service.send_synchronous_message(self.user.id, message)
+            result = call(rpc_service, range_token)
 
             if result['status'] == 'delivered':
                 print(f"Mensagem RPC enviada com sucesso para {target_user.name}")
@@ -309,179 +948,1982 @@ class RPCClient:
 import pika
 
 
-class MOMCommunication:
-    def __init__(self, user: User, central_server: CentralServer):
-        self.user = user
-        self.central_server = central_server
+class SharedAMQPConnection:
+    """Conexão AMQP compartilhada por vários usuários do processo.
+
+    BlockingConnection não é thread-safe: uma única thread de I/O é dona da
+    conexão, processa os eventos de todos os canais e é a única publicadora.
+    As demais threads colocam operações numa fila sem lock (SimpleQueue); a
+    thread de I/O é acordada uma vez por rajada e esvazia a fila inteira, de
+    modo que publicações concorrentes saem num único flush. Se a conexão
+    cair, a thread reconecta com backoff e avisa os listeners registrados.
+    """
+
+    def __init__(self, parameters: pika.ConnectionParameters, name: str,
+                 reconnect_delay: float = 1.0, max_reconnect_delay: float = 30.0):
+        self.parameters = parameters
+        self.name = name
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
         self.connection = None
-        self.channel = None
-        self.consuming = False
-        self.message_handler = None
-        self.consume_thread = None
+        self.running = False
+        self.io_thread = None
+        self.first_attempt = threading.Event()
+        self.owners = set()
+        self.reconnect_listeners: List[Callable] = []
+        self.sessions = 0
+        # Operações pendentes para a thread de I/O: (fn, args, future)
+        self.work_queue = queue.SimpleQueue()
+        self.drain_scheduled = False
+        self.drains = 0
+        self.drained_items = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.connection is not None and self.connection.is_open
+
+    def start(self, timeout: float = 10.0) -> bool:
+        """Inicia a thread de I/O e aguarda a primeira tentativa de conexão"""
+        if not self.running:
+            self.running = True
+            self.io_thread = threading.Thread(target=self._io_loop, name=f"amqp-{self.name}")
+            self.io_thread.daemon = True
+            self.io_thread.start()
+        self.first_attempt.wait(timeout)
+        return self.is_open
+
+    def stop(self):
+        self.running = False
+        try:
+            # Acorda o loop para que ele perceba a parada e feche a conexão
+            self.submit(lambda: None)
+        except Exception:
+            pass
 
-    def set_message_handler(self, handler: Callable):
-        """Define handler para processar mensagens recebidas"""
-        self.message_handler = handler
+    def submit(self, fn: Callable, *args) -> Future:
+        """Agenda fn(*args) na thread de I/O e retorna um Future com o resultado"""
+        future = Future()
+        if threading.current_thread() is self.io_thread:
+            self._run(fn, args, future)
+            return future
+
+        if not self.is_open:
+            future.set_exception(ConnectionError(f"Conexão AMQP {self.name} indisponível"))
+            return future
+
+        self.work_queue.put((fn, args, future))
+        # Só acorda a thread de I/O se ainda não houver drenagem agendada
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            try:
+                self.connection.add_callback_threadsafe(self._drain_work)
+            except Exception as e:
+                self.drain_scheduled = False
+                self._fail_queued_work(e)
+        return future
 
-    def connect(self):
+    def call(self, fn: Callable, *args, timeout: float = 10.0):
+        """Executa fn(*args) na thread de I/O e aguarda o resultado"""
+        return self.submit(fn, *args).result(timeout=timeout)
+
+    @staticmethod
+    def _run(fn: Callable, args: tuple, future: Future):
+        if not future.set_running_or_notify_cancel():
+            return
         try:
-            # Tentar reconectar se a conexão estiver fechada
-            if self.connection and not self.connection.is_closed:
-                return True
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
 
-            self.connection = pika.BlockingConnection(
-                pika.ConnectionParameters('localhost', heartbeat=600, blocked_connection_timeout=300)
-            )
-            self.channel = self.connection.channel()
+    def _drain_work(self):
+        # Libera o agendamento antes de esvaziar a fila: um put concorrente
+        # que não for visto aqui agenda uma nova drenagem
+        self.drain_scheduled = False
+        self.drains += 1
+        while True:
+            try:
+                fn, args, future = self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._run(fn, args, future)
+            self.drained_items += 1
+
+    def _fail_queued_work(self, error: Exception):
+        while True:
+            try:
+                _, _, future = self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if not future.done():
+                future.set_exception(error)
+
+    def _io_loop(self):
+        delay = self.reconnect_delay
+        while self.running:
+            try:
+                self.connection = pika.BlockingConnection(self.parameters)
+            except Exception as e:
+                print(f"Erro ao conectar com RabbitMQ ({self.name}): {e}")
+                if not self.sessions:
+                    # Nunca conectou: desiste e deixa o chamador tentar novamente
+                    self.running = False
+                    self.first_attempt.set()
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+
+            delay = self.reconnect_delay
+            self.sessions += 1
+            self.first_attempt.set()
+            if self.sessions > 1:
+                print(f"Conexão AMQP {self.name} restabelecida")
+                for listener in list(self.reconnect_listeners):
+                    try:
+                        listener()
+                    except Exception as e:
+                        print(f"Erro ao restaurar canais após reconexão: {e}")
+
+            try:
+                # Orientado a eventos: bloqueia no seletor até chegar I/O, vencer
+                # um timer (call_later) ou outra thread acordar o loop (submit/stop)
+                while self.running and self.connection.is_open:
+                    self.connection.process_data_events(time_limit=None)
+            except Exception as e:
+                print(f"Conexão AMQP {self.name} perdida: {e}")
+            finally:
+                try:
+                    if self.connection.is_open:
+                        self.connection.close()
+                except Exception:
+                    pass
+                # Operações que não chegaram a executar não sobrevivem à sessão
+                self.drain_scheduled = False
+                self._fail_queued_work(ConnectionError(f"Conexão AMQP {self.name} encerrada"))
+
+
+class AMQPConnectionManager:
+    """Distribui os usuários do processo entre poucas conexões AMQP compartilhadas"""
+
+    def __init__(self, host: str = 'localhost', max_connections: int = 2, heartbeat: int = 600,
+                 blocked_connection_timeout: int = 300):
+        self.parameters = pika.ConnectionParameters(
+            host, heartbeat=heartbeat, blocked_connection_timeout=blocked_connection_timeout
+        )
+        self.max_connections = max_connections
+        self.connections: List[SharedAMQPConnection] = []
+        self.assignments: Dict[str, SharedAMQPConnection] = {}
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self, owner_id: str) -> Optional[SharedAMQPConnection]:
+        """Retorna a conexão do usuário, atribuindo a menos carregada se preciso"""
+        with self.lock:
+            shared = self.assignments.get(owner_id)
+            if shared and shared.running:
+                return shared
+
+            self.connections = [c for c in self.connections if c.running]
+            if len(self.connections) < self.max_connections:
+                shared = SharedAMQPConnection(self.parameters, f"conn-{self.created}")
+                self.created += 1
+                if not shared.start():
+                    shared.stop()
+                    return None
+                self.connections.append(shared)
+            else:
+                shared = min(self.connections, key=lambda c: len(c.owners))
+
+            shared.owners.add(owner_id)
+            self.assignments[owner_id] = shared
+            return shared
+
+    def release(self, owner_id: str):
+        """Libera o usuário; conexões sem usuários são fechadas"""
+        with self.lock:
+            shared = self.assignments.pop(owner_id, None)
+            if not shared:
+                return
+            shared.owners.discard(owner_id)
+            if not shared.owners:
+                shared.stop()
+                if shared in self.connections:
+                    self.connections.remove(shared)
+
+    def get_stats(self) -> List[dict]:
+        with self.lock:
+            return [{
+                'name': c.name,
+                'open': c.is_open,
+                'users': len(c.owners),
+                'sessions': c.sessions,
+                'queued': c.work_queue.qsize(),
+                'drains': c.drains,
+                'drained_items': c.drained_items
+            } for c in self.connections]
+
+
+_amqp_connection_manager = None
+_amqp_connection_manager_lock = threading.Lock()
+
+
+def get_amqp_connection_manager() -> AMQPConnectionManager:
+    """Retorna o gerenciador de conexões AMQP compartilhado pelo processo"""
+    global _amqp_connection_manager
+    with _amqp_connection_manager_lock:
+        if _amqp_connection_manager is None:
+            _amqp_connection_manager = AMQPConnectionManager()
+        return _amqp_connection_manager
+
+
+# Motivos de descarte reportados pelo broker (cabeçalho x-death do RabbitMQ)
+DEAD_LETTER_REASONS = ('maxlen', 'expired', 'rejected')
+
+# Resultado de cada mensagem de um lote entregue ao on_batch de uma sessão
+DELIVERY_ACK = 'ack'          # processada: confirmar
+DELIVERY_REJECT = 'reject'    # inválida ou com erro: descartar (dead-letter 'rejected')
+DELIVERY_REQUEUE = 'requeue'  # não pôde ser processada agora: devolver à fila
+
+
+def _run_batch_handler(on_batch: Callable, bodies: list) -> List[str]:
+    """Executa on_batch e retorna o resultado de cada mensagem, na ordem.
+
+    on_batch retorna None (todas processadas) ou uma lista de resultados;
+    uma exceção rejeita o lote inteiro, pois não se sabe até onde foi."""
+    try:
+        outcomes = on_batch(bodies)
+    except Exception as e:
+        print(f"Erro ao processar lote de mensagens assíncronas: {e}")
+        return [DELIVERY_REJECT] * len(bodies)
+    return list(outcomes) if outcomes is not None else [DELIVERY_ACK] * len(bodies)
+
+
+class DeliveryWorker:
+    """Thread única que executa, em ordem, os handlers de uma sessão.
+
+    Tira o processamento das mensagens da thread do broker (I/O AMQP
+    compartilhado ou despachante em processo), que só entrega e confirma.
+    """
+
+    def __init__(self, name: str):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.thread = None
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.executor.submit(self._run, fn, args)
+
+    def _run(self, fn: Callable, args: tuple):
+        self.thread = threading.current_thread()
+        return fn(*args)
+
+    def stop(self):
+        # Aguarda os lotes em andamento, exceto quando chamado pelo próprio handler
+        self.executor.shutdown(wait=threading.current_thread() is not self.thread)
 
-            queue_name = f"user_{self.user.id}"
-            self.channel.queue_declare(queue=queue_name, durable=True)
 
+class BrokerSession(ABC):
+    """Sessão de um usuário num BrokerBackend, usada pelo MOMCommunication.
+
+    A sessão publica em filas duráveis e entrega ao consumidor lotes de corpos
+    de mensagem (bytes ou str); cada mensagem é confirmada, rejeitada ou
+    devolvida à fila conforme o resultado retornado pelo consumidor (ver
+    _run_batch_handler). As publicações retornam um Future resolvido com
+    True quando aceitas (ou confirmadas, no modo confirmado) e False em erro.
+    """
+
+    @property
+    @abstractmethod
+    def is_open(self) -> bool:
+        """A sessão pode publicar e consumir"""
+
+    @property
+    def is_recovering(self) -> bool:
+        """A conexão caiu e a sessão se restabelece sozinha; não deve ser substituída"""
+        return False
+
+    @abstractmethod
+    def declare_queue(self, queue_name: str):
+        """Declara a fila com os argumentos da sessão"""
+
+    @abstractmethod
+    def publish(self, queue_name: str, body: str) -> Future:
+        """Publica na fila"""
+
+    @abstractmethod
+    def publish_multi(self, queue_names: List[str], body: str) -> Future:
+        """Publica uma única vez para várias filas"""
+
+    @abstractmethod
+    def publish_topic(self, routing_key: str, body: str) -> Future:
+        """Publica na exchange de grupos (semântica AMQP topic)"""
+
+    @abstractmethod
+    def bind_topic(self, queue_name: str, routing_key: str):
+        """Vincula a fila a um padrão da exchange de grupos"""
+
+    @abstractmethod
+    def unbind_topic(self, queue_name: str, routing_key: str):
+        """Desfaz o vínculo criado por bind_topic"""
+
+    @abstractmethod
+    def flush(self):
+        """Confirma imediatamente as publicações pendentes do modo confirmado"""
+
+    @abstractmethod
+    def start_consuming(self, queue_name: str, on_batch: Callable) -> bool:
+        """Passa a entregar lotes da fila a on_batch; False se já houver consumidor"""
+
+    @abstractmethod
+    def drain(self, queue_name: str, on_batch: Callable, max_messages: int = None, timeout: float = 60.0) -> int:
+        """Entrega o backlog da fila como um único lote e retorna seu tamanho"""
+
+    @abstractmethod
+    def dead_letter_stats(self) -> Dict[str, int]:
+        """Mensagens descartadas por motivo"""
+
+    @abstractmethod
+    def close(self):
+        """Encerra o consumo e libera os recursos da sessão"""
+
+
+class BrokerBackend(ABC):
+    """Interface de broker usada pelo MOMCommunication.
+
+    Cada usuário abre uma BrokerSession com open_session. As filas aceitam os
+    argumentos AMQP x-max-length, x-message-ttl e x-dead-letter-exchange;
+    mensagens descartadas vão para uma fila por motivo (maxlen, expired,
+    rejected), limitada a dead_letter_max_length, e get_dead_letter_stats
+    retorna quantas mensagens essas filas retêm, nos dois backends.
+    """
+
+    name = "abstract"
+
+    @abstractmethod
+    def open_session(self, owner_id: str, **options) -> Optional[BrokerSession]:
+        """Abre a sessão do usuário; retorna None se o broker estiver indisponível"""
+
+    @abstractmethod
+    def get_dead_letter_stats(self) -> Dict[str, int]:
+        """Retorna as mensagens descartadas por motivo"""
+
+    @staticmethod
+    def dead_letter_queue(exchange: str, reason: str) -> str:
+        """Fila que retém as mensagens descartadas por um motivo"""
+        return f"{exchange}.{reason}"
+
+
+class RabbitMQSession(BrokerSession):
+    """Canais de um usuário numa conexão AMQP compartilhada.
+
+    Os métodos com prefixo _ executam na thread de I/O da conexão.
+    """
+
+    def __init__(self, broker: 'RabbitMQBroker', owner_id: str,
+                 confirm_mode: bool = False, confirm_batch_size: int = 100,
+                 confirm_interval_ms: int = 0, prefetch_count: int = 100,
+                 ack_batch_size: int = 50, ack_interval_ms: int = 0,
+                 queue_arguments: dict = None, exchange: str = "mom.direct",
+                 group_exchange: str = "mom.groups"):
+        self.broker = broker
+        self.connection_manager = broker.connection_manager
+        self.owner_id = owner_id
+        # Publicador e consumidor declaram a fila com os mesmos argumentos;
+        # o RabbitMQ recusa (PRECONDITION_FAILED) redeclarações divergentes
+        self.queue_arguments = queue_arguments or {}
+        self.dead_letter_exchange = self.queue_arguments.get('x-dead-letter-exchange')
+        # Exchange direta (routing key = nome da fila) e exchange topic de grupos
+        self.exchange = exchange
+        self.group_exchange = group_exchange
+        self.shared_connection = None
+        self.channel = None
+        # Canal dedicado a publicações, mantido aberto entre envios
+        self.publish_channel = None
+        # Filas já declaradas na sessão atual da conexão
+        self.declared_queues = set()
+        # Modo confirmado: publicações são confirmadas em lote, a cada
+        # confirm_batch_size mensagens ou confirm_interval_ms milissegundos;
+        # com confirm_interval_ms = 0 o lote é confirmado ao fim da rajada de
+        # I/O atual, então um envio isolado não espera nenhum intervalo
+        self.confirm_mode = confirm_mode
+        self.confirm_batch_size = confirm_batch_size
+        self.confirm_interval_ms = confirm_interval_ms
+        self.pending_confirms: List[Future] = []
+        self.confirm_timer = None
+        # Consumo: prefetch configurável e ack múltiplo a cada ack_batch_size
+        # mensagens ou ack_interval_ms milissegundos; com ack_interval_ms = 0 o
+        # lote é entregue ao fim de cada rajada de I/O, sem espera adicional
+        self.prefetch_count = prefetch_count
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval_ms = ack_interval_ms
+        self.consumer_tag = None
+        self.consume_queue = None
+        self.on_batch = None
+        self.pending_deliveries = []
+        self.ack_timer = None
+        # Handlers rodam no worker da sessão; a thread de I/O, compartilhada
+        # com outros usuários, só recebe e confirma. Como o ack só sai depois
+        # do handler, o prefetch limita o que fica em processamento
+        self.delivery_worker = DeliveryWorker(f"mom-{owner_id[:8]}")
+        # Drenagem do backlog em andamento (consumidor temporário)
+        self.active_drain = None
+
+    @property
+    def is_open(self) -> bool:
+        return (self.shared_connection is not None and self.shared_connection.is_open and
+                self.channel is not None and self.channel.is_open)
+
+    @property
+    def is_recovering(self) -> bool:
+        """A conexão caiu e está sendo restabelecida; canais e consumidor voltam sozinhos"""
+        shared = self.shared_connection
+        return shared is not None and shared.running and not shared.is_open
+
+    def open(self) -> bool:
+        try:
+            self.shared_connection = self.connection_manager.acquire(self.owner_id)
+            if not self.shared_connection:
+                return False
+            if self._on_reconnect not in self.shared_connection.reconnect_listeners:
+                self.shared_connection.reconnect_listeners.append(self._on_reconnect)
+
+            self.shared_connection.call(self._open_channels)
             return True
         except Exception as e:
             print(f"Erro ao conectar com RabbitMQ: {e}")
+            # Remove o listener e libera a conexão: uma sessão que falhou ao
+            # abrir não pode reabrir canais na próxima reconexão
+            self.close()
+            return False
+
+    def declare_queue(self, queue_name: str):
+        self.shared_connection.call(self._ensure_queue, self.channel, queue_name)
+
+    def publish(self, queue_name: str, body: str) -> Future:
+        """Publica na fila; o Future resolve com True quando a publicação é
+        aceita (ou confirmada pelo broker, no modo confirmado) e False em erro"""
+        return self._submit_publish(self.exchange, queue_name, body, [queue_name], [])
+
+    def _submit_publish(self, *args) -> Future:
+        future = Future()
+
+        def on_scheduled(scheduled: Future):
+            if scheduled.exception() and not future.done():
+                print(f"Erro ao enviar mensagem assíncrona: {scheduled.exception()}")
+                future.set_result(False)
+
+        self.shared_connection.submit(self._publish, *args, future).add_done_callback(on_scheduled)
+        return future
+
+    def publish_multi(self, queue_names: List[str], body: str) -> Future:
+        """Publica uma única vez para várias filas; o broker replica a mensagem
+        usando o cabeçalho BCC (distribuição selecionada pelo remetente)"""
+        return self._submit_publish(self.exchange, queue_names[0], body, queue_names, queue_names[1:])
+
+    def publish_topic(self, routing_key: str, body: str) -> Future:
+        """Publica na exchange de grupos para todas as filas com binding compatível"""
+        return self._submit_publish(self.group_exchange, routing_key, body, [], [])
+
+    def bind_topic(self, queue_name: str, routing_key: str):
+        self.shared_connection.call(self._bind_topic, queue_name, routing_key, True)
+
+    def unbind_topic(self, queue_name: str, routing_key: str):
+        self.shared_connection.call(self._bind_topic, queue_name, routing_key, False)
+
+    def flush(self):
+        """Confirma imediatamente o lote pendente"""
+        if self.shared_connection and self.shared_connection.is_open:
+            self.shared_connection.call(self._flush_confirms)
+
+    def start_consuming(self, queue_name: str, on_batch: Callable) -> bool:
+        return self.shared_connection.call(self._start_consuming, queue_name, on_batch)
+
+    def drain(self, queue_name: str, on_batch: Callable, max_messages: int = None, timeout: float = 60.0) -> int:
+        """Retira o backlog da fila e o entrega como um único lote ordenado.
+
+        A thread de I/O apenas inicia um consumidor temporário e continua
+        atendendo os demais usuários da conexão; quem espera é o chamador."""
+        done = Future()
+        self.shared_connection.call(self._start_drain, queue_name, on_batch, max_messages, done)
+        return done.result(timeout=timeout)
+
+    def close(self):
+        shared = self.shared_connection
+        if shared and shared.is_open:
+            try:
+                # Para as entregas e espera os lotes em andamento, cujos acks
+                # são enfileirados na thread de I/O antes do fechamento
+                shared.call(self._cancel_consumers)
+            except Exception:
+                pass
+        self.delivery_worker.stop()
+        if shared and shared.is_open:
+            try:
+                shared.call(self._close_channels)
+            except Exception:
+                pass
+
+        if shared:
+            if self._on_reconnect in shared.reconnect_listeners:
+                shared.reconnect_listeners.remove(self._on_reconnect)
+            self.connection_manager.release(self.owner_id)
+        self.shared_connection = None
+
+    def _open_channels(self):
+        self.channel = self.shared_connection.connection.channel()
+        self.publish_channel = self._open_publish_channel()
+        self.declared_queues = set()
+
+    def _on_reconnect(self):
+        # Tags de entrega e transações do canal antigo não valem mais;
+        # o broker reentrega as mensagens que ficaram sem ack
+        self.pending_deliveries = []
+        self.ack_timer = None
+        self.confirm_timer = None
+        self._fail_pending_confirms()
+        if self.active_drain:
+            # Entregas sem ack voltam para a fila no broker
+            self.active_drain['done'].set_result(0)
+            self.active_drain = None
+        was_consuming = self.consumer_tag is not None
+        self.consumer_tag = None
+        self._open_channels()
+        if was_consuming:
+            self._start_consuming(self.consume_queue, self.on_batch)
+
+    def _get_publish_channel(self):
+        """Retorna o canal de publicação, reabrindo-o se tiver sido fechado"""
+        if not self.publish_channel or self.publish_channel.is_closed:
+            self.publish_channel = self._open_publish_channel()
+            # Um canal fechado por erro pode indicar fila removida: redeclarar tudo
+            self.declared_queues = set()
+        return self.publish_channel
+
+    def _open_publish_channel(self):
+        channel = self.shared_connection.connection.channel()
+        if self.confirm_mode:
+            # No BlockingChannel, confirm_delivery aguarda o ack de cada publicação;
+            # uma transação AMQP confirma o lote inteiro com um único tx_commit
+            channel.tx_select()
+        return channel
+
+    def dead_letter_stats(self) -> Dict[str, int]:
+        """Conta as mensagens retidas nas filas de dead-letter, sem consumi-las"""
+        if self.dead_letter_exchange and self.is_open:
+            self.broker.record_dead_letters(self.shared_connection.call(self._count_dead_letters))
+        return self.broker.get_dead_letter_stats()
+
+    def _ensure_queue(self, channel, queue_name: str):
+        """Declara e vincula a fila apenas na primeira publicação da sessão"""
+        if queue_name not in self.declared_queues:
+            if self.exchange not in self.declared_queues:
+                channel.exchange_declare(exchange=self.exchange, exchange_type='direct', durable=True)
+                channel.exchange_declare(exchange=self.group_exchange, exchange_type='topic', durable=True)
+                self.declared_queues.add(self.exchange)
+            if self.dead_letter_exchange and self.dead_letter_exchange not in self.declared_queues:
+                self._declare_dead_letter(channel)
+            channel.queue_declare(queue=queue_name, durable=True, arguments=self.queue_arguments)
+            channel.queue_bind(queue=queue_name, exchange=self.exchange, routing_key=queue_name)
+            self.declared_queues.add(queue_name)
+
+    def _bind_topic(self, queue_name: str, routing_key: str, bind: bool):
+        self._ensure_queue(self.channel, queue_name)
+        if bind:
+            self.channel.queue_bind(queue=queue_name, exchange=self.group_exchange, routing_key=routing_key)
+        else:
+            self.channel.queue_unbind(queue=queue_name, exchange=self.group_exchange, routing_key=routing_key)
+
+    def _declare_dead_letter(self, channel):
+        # Exchange headers com uma fila limitada por motivo de descarte
+        # (cabeçalho x-first-death-reason), para que as contagens venham do
+        # message_count das filas sem consumir as mensagens retidas. Com
+        # x-match 'all' os cabeçalhos x- seriam ignorados na comparação e toda
+        # mensagem iria para as três filas; 'all-with-x' os considera
+        channel.exchange_declare(exchange=self.dead_letter_exchange, exchange_type='headers', durable=True)
+        for reason in DEAD_LETTER_REASONS:
+            queue_name = self.broker.dead_letter_queue(self.dead_letter_exchange, reason)
+            channel.queue_declare(queue=queue_name, durable=True,
+                                  arguments={'x-max-length': self.broker.dead_letter_max_length})
+            channel.queue_bind(queue=queue_name, exchange=self.dead_letter_exchange,
+                               arguments={'x-match': 'all-with-x', 'x-first-death-reason': reason})
+        self.declared_queues.add(self.dead_letter_exchange)
+
+    def _count_dead_letters(self) -> Dict[str, int]:
+        if self.dead_letter_exchange not in self.declared_queues:
+            self._declare_dead_letter(self.channel)
+        return {
+            reason: self.channel.queue_declare(
+                queue=self.broker.dead_letter_queue(self.dead_letter_exchange, reason), passive=True
+            ).method.message_count
+            for reason in DEAD_LETTER_REASONS
+        }
+
+    def _publish(self, exchange: str, routing_key: str, body: str, queue_names: List[str],
+                 bcc: List[str], future: Future):
+        try:
+            channel = self._get_publish_channel()
+            # Sem fila declarada a mensagem não seria roteada; o cache da
+            # sessão limita as declarações à primeira publicação por destino
+            for queue_name in queue_names:
+                self._ensure_queue(channel, queue_name)
+            channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=body,
+                properties=pika.BasicProperties(delivery_mode=2, headers={'BCC': bcc} if bcc else None)
+            )
+        except Exception as e:
+            print(f"Erro ao enviar mensagem assíncrona: {e}")
+            if self.confirm_mode:
+                self._fail_pending_confirms()
+            # Força a reabertura do canal na próxima publicação
+            self.publish_channel = None
+            future.set_result(False)
+            return
+
+        if not self.confirm_mode:
+            future.set_result(True)
+            return
+
+        self.pending_confirms.append(future)
+        if len(self.pending_confirms) >= self.confirm_batch_size:
+            self._flush_confirms()
+        elif self.confirm_timer is None:
+            self.confirm_timer = self.shared_connection.connection.call_later(
+                self.confirm_interval_ms / 1000.0, self._on_confirm_timer
+            )
+
+    def _on_confirm_timer(self):
+        self.confirm_timer = None
+        self._flush_confirms()
+
+    def _flush_confirms(self):
+        if self.confirm_timer:
+            self.shared_connection.connection.remove_timeout(self.confirm_timer)
+            self.confirm_timer = None
+        if not self.pending_confirms:
+            return
+
+        try:
+            self.publish_channel.tx_commit()
+        except Exception as e:
+            print(f"Erro ao confirmar lote de mensagens assíncronas: {e}")
+            self._fail_pending_confirms()
+            return
+
+        batch, self.pending_confirms = self.pending_confirms, []
+        for future in batch:
+            future.set_result(True)
+        print(f"Lote de {len(batch)} mensagens assíncronas confirmado pelo broker")
+
+    def _fail_pending_confirms(self):
+        # A transação aberta é perdida junto com o canal
+        batch, self.pending_confirms = self.pending_confirms, []
+        self.publish_channel = None
+        for future in batch:
+            future.set_result(False)
+
+    def _start_consuming(self, queue_name: str, on_batch: Callable) -> bool:
+        if self.consumer_tag:
+            # Já consumindo neste canal: evita registrar um segundo consumidor
             return False
 
-    def send_async_message(self, target_user_id: str, message: str) -> bool:
+        self.consume_queue = queue_name
+        self.on_batch = on_batch
+        self._ensure_queue(self.channel, queue_name)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.consumer_tag = self.channel.basic_consume(
+            queue=queue_name,
+            on_message_callback=self._on_message
+        )
+        return True
+
+    # Sem novas entregas por este intervalo, a drenagem termina com o que chegou
+    # (o message_count pode incluir mensagens que expiraram no caminho)
+    DRAIN_IDLE_INTERVAL = 1.0
+
+    def _start_drain(self, queue_name: str, on_batch: Callable, max_messages: Optional[int], done: Future):
+        if self.active_drain:
+            raise RuntimeError("Drenagem do backlog já em andamento")
+        self._ensure_queue(self.channel, queue_name)
+        backlog = self.channel.queue_declare(queue=queue_name, passive=True).method.message_count
+        limit = backlog if max_messages is None else min(backlog, max_messages)
+        if limit <= 0:
+            done.set_result(0)
+            return
+
+        # Consumidor com prefetch igual ao backlog (o campo AMQP tem 16 bits):
+        # o broker envia tudo sem ida e volta por mensagem, e um único ack
+        # múltiplo confirma o lote ao final
+        self.channel.basic_qos(prefetch_count=min(limit, 65535))
+        self.active_drain = {'limit': limit, 'on_batch': on_batch, 'done': done,
+                             'deliveries': [], 'progress': 0}
+        self.active_drain['consumer_tag'] = self.channel.basic_consume(
+            queue=queue_name, on_message_callback=self._on_drain_message
+        )
+        self._schedule_drain_idle_check()
+
+    def _schedule_drain_idle_check(self):
+        self.active_drain['timer'] = self.shared_connection.connection.call_later(
+            self.DRAIN_IDLE_INTERVAL, self._on_drain_idle_check
+        )
+
+    def _on_drain_message(self, ch, method, properties, body):
+        drain = self.active_drain
+        if drain is None:
+            return
+        drain['deliveries'].append((method.delivery_tag, body))
+        if len(drain['deliveries']) >= drain['limit']:
+            self._finish_drain()
+
+    def _on_drain_idle_check(self):
+        drain = self.active_drain
+        if drain is None:
+            return
+        if len(drain['deliveries']) == drain['progress']:
+            self._finish_drain()
+        else:
+            drain['progress'] = len(drain['deliveries'])
+            self._schedule_drain_idle_check()
+
+    def _finish_drain(self):
+        drain, self.active_drain = self.active_drain, None
+        self.shared_connection.connection.remove_timeout(drain['timer'])
+        try:
+            self.channel.basic_cancel(drain['consumer_tag'])
+        finally:
+            if drain['deliveries']:
+                self._hand_off(drain['deliveries'], drain['on_batch'], drain['done'])
+            else:
+                drain['done'].set_result(0)
+
+    def _on_message(self, ch, method, properties, body):
+        self.pending_deliveries.append((method.delivery_tag, body))
+        if len(self.pending_deliveries) >= self.ack_batch_size:
+            self._flush_deliveries()
+        elif self.ack_timer is None:
+            # Timers só disparam depois que as entregas já lidas do socket
+            # foram despachadas, então um timer de 0 s fecha a rajada atual
+            self.ack_timer = self.shared_connection.connection.call_later(
+                self.ack_interval_ms / 1000.0, self._on_ack_timer
+            )
+
+    def _on_ack_timer(self):
+        self.ack_timer = None
+        self._flush_deliveries()
+
+    def _flush_deliveries(self):
+        """Passa o lote acumulado ao worker da sessão"""
+        if self.ack_timer:
+            self.shared_connection.connection.remove_timeout(self.ack_timer)
+            self.ack_timer = None
+        if not self.pending_deliveries:
+            return
+
+        batch, self.pending_deliveries = self.pending_deliveries, []
+        self._hand_off(batch, self.on_batch)
+
+    def _hand_off(self, batch: list, on_batch: Callable, done: Future = None):
+        # As tags de entrega só valem no canal em que chegaram
         try:
-            if not self.channel or not self.connection or self.connection.is_closed:
-                if not self.connect():
+            self.delivery_worker.submit(self._deliver, self.channel, batch, on_batch, done)
+        except RuntimeError:
+            # Sessão encerrada: sem ack, o broker reentrega as mensagens
+            if done:
+                done.set_result(0)
+
+    def _deliver(self, channel, batch: list, on_batch: Callable, done: Optional[Future]):
+        """Executa no worker da sessão; os acks voltam para a thread de I/O"""
+        outcomes = _run_batch_handler(on_batch, [body for _, body in batch])
+        shared = self.shared_connection
+        if shared:
+            shared.submit(self._settle, channel, [tag for tag, _ in batch], outcomes)
+        if done:
+            done.set_result(len(batch))
+
+    def _settle(self, channel, tags: List[int], outcomes: List[str]):
+        if channel is not self.channel or not channel.is_open:
+            return  # Canal trocado ou fechado: o broker reentrega
+        if all(outcome == DELIVERY_ACK for outcome in outcomes):
+            channel.basic_ack(delivery_tag=tags[-1], multiple=True)
+            return
+        # Lote misto: cada mensagem conforme o próprio resultado
+        for tag, outcome in zip(tags, outcomes):
+            if outcome == DELIVERY_ACK:
+                channel.basic_ack(delivery_tag=tag)
+            else:
+                channel.basic_nack(delivery_tag=tag, requeue=outcome == DELIVERY_REQUEUE)
+
+    def _cancel_consumers(self):
+        if self.consumer_tag and self.channel and self.channel.is_open:
+            self.channel.basic_cancel(self.consumer_tag)
+        self.consumer_tag = None
+        self._flush_deliveries()
+        if self.active_drain:
+            self._finish_drain()
+
+    def _close_channels(self):
+        if self.confirm_mode:
+            self._flush_confirms()
+        for channel in (self.channel, self.publish_channel):
+            try:
+                if channel and channel.is_open:
+                    channel.close()
+            except Exception:
+                pass
+        self.channel = None
+        self.publish_channel = None
+        self.consumer_tag = None
+
+
+class RabbitMQBroker(BrokerBackend):
+    """Broker RabbitMQ sobre as conexões compartilhadas do processo.
+
+    As mensagens descartadas ficam nas filas de dead-letter (uma por motivo,
+    até dead_letter_max_length cada, descartando as mais antigas) para
+    inspeção; as estatísticas são o message_count dessas filas, iguais para
+    todos os processos, e não um total acumulado.
+    """
+
+    name = "rabbitmq"
+
+    def __init__(self, connection_manager: AMQPConnectionManager = None, dead_letter_max_length: int = 10000):
+        self.connection_manager = connection_manager or get_amqp_connection_manager()
+        self.dead_letter_max_length = dead_letter_max_length
+        self.dead_letter_counts = {reason: 0 for reason in DEAD_LETTER_REASONS}
+        self.stats_lock = threading.Lock()
+
+    def open_session(self, owner_id: str, **options) -> Optional[RabbitMQSession]:
+        session = RabbitMQSession(self, owner_id, **options)
+        return session if session.open() else None
+
+    def record_dead_letters(self, counts: Dict[str, int]):
+        with self.stats_lock:
+            self.dead_letter_counts.update(counts)
+
+    def get_dead_letter_stats(self) -> Dict[str, int]:
+        """Última contagem lida das filas de dead-letter"""
+        with self.stats_lock:
+            return dict(self.dead_letter_counts)
+
+
+class InProcessQueue:
+    """Fila durável do InProcessBroker.
+
+    Cada publicação e cada ack viram uma linha JSON no arquivo da fila; ao
+    reabrir, as mensagens publicadas e não confirmadas voltam a ficar prontas
+    e o arquivo é compactado. Limite de tamanho e TTL seguem a semântica do
+    RabbitMQ: descarte pela cabeça e expiração apenas das mensagens prontas.
+    Com x-dead-letter-exchange, as descartadas são repassadas a
+    dead_letter_sink(exchange, motivo, corpos).
+    """
+
+    def __init__(self, name: str, path: str, fsync: bool = False, arguments: dict = None,
+                 dead_letter_sink: Callable = None):
+        self.name = name
+        self.path = path
+        self.fsync = fsync
+        arguments = arguments or {}
+        self.max_length = arguments.get('x-max-length')
+        self.message_ttl = arguments['x-message-ttl'] / 1000.0 if arguments.get('x-message-ttl') else None
+        self.dead_letter_exchange = arguments.get('x-dead-letter-exchange')
+        self.dead_letter_sink = dead_letter_sink
+        self.ready = deque()  # (seq, body, expires_at) aguardando entrega
+        self.unacked: Dict[int, tuple] = {}
+        self.next_seq = 1
+        self.consumer = None
+        self.dead_letters = {reason: 0 for reason in DEAD_LETTER_REASONS}
+        self._load()
+        self.log = open(self.path, 'a', encoding='utf-8')
+        self.expire()
+
+    def _load(self):
+        pending = OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Linha truncada por queda do processo
+                    if record['op'] == 'pub':
+                        pending[record['seq']] = (record['body'], record.get('ts', time.time()))
+                    else:
+                        pending.pop(record['seq'], None)
+                    self.next_seq = max(self.next_seq, record['seq'] + 1)
+
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for seq, (body, ts) in pending.items():
+                f.write(json.dumps({'op': 'pub', 'seq': seq, 'body': body, 'ts': ts}) + '\n')
+        self.ready = deque((seq, body, self._expires_at(ts)) for seq, (body, ts) in pending.items())
+
+    def _expires_at(self, ts: float) -> Optional[float]:
+        return ts + self.message_ttl if self.message_ttl else None
+
+    def append(self, body: str):
+        seq = self.next_seq
+        self.next_seq += 1
+        ts = time.time()
+        self._write({'op': 'pub', 'seq': seq, 'body': body, 'ts': ts})
+        self.ready.append((seq, body, self._expires_at(ts)))
+
+        if self.max_length is not None:
+            dropped = []
+            while len(self.ready) > self.max_length:
+                dropped.append(self.ready.popleft()[:2])
+            self._dead_letter(dropped, 'maxlen')
+
+    def expire(self):
+        """Descarta as mensagens prontas cujo TTL venceu"""
+        if not self.message_ttl:
+            return
+        now = time.time()
+        expired = []
+        while self.ready and self.ready[0][2] <= now:
+            expired.append(self.ready.popleft()[:2])
+        self._dead_letter(expired, 'expired')
+
+    def settle(self, seqs: List[int], reason: str = None):
+        """Remove definitivamente as mensagens (ack ou rejeição)"""
+        settled = [(seq, self.unacked.pop(seq)[0]) for seq in seqs if seq in self.unacked]
+        if reason:
+            self._dead_letter(settled, reason)
+            return
+        for seq, _ in settled:
+            self.log.write(json.dumps({'op': 'ack', 'seq': seq}) + '\n')
+        self.log.flush()
+
+    def _dead_letter(self, items: List[tuple], reason: str):
+        if not items:
+            return
+        for seq, _ in items:
+            self.log.write(json.dumps({'op': 'ack', 'seq': seq}) + '\n')
+        self.log.flush()
+        self.dead_letters[reason] += len(items)
+        if self.dead_letter_exchange and self.dead_letter_sink:
+            self.dead_letter_sink(self.dead_letter_exchange, reason, [body for _, body in items])
+
+    def requeue(self, seqs):
+        # Entregas sem ack voltam para o início da fila, na ordem original, como no AMQP
+        items = [(seq, *self.unacked.pop(seq)) for seq in sorted(seqs) if seq in self.unacked]
+        self.ready.extendleft(reversed(items))
+
+    def sync(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def _write(self, record: dict):
+        self.log.write(json.dumps(record) + '\n')
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+
+
+class InProcessSession(BrokerSession):
+    """Sessão de um usuário no InProcessBroker"""
+
+    def __init__(self, broker: 'InProcessBroker', owner_id: str, confirm_mode: bool = False,
+                 prefetch_count: int = 100, ack_batch_size: int = 50, queue_arguments: dict = None,
+                 **options):
+        self.broker = broker
+        self.owner_id = owner_id
+        self.confirm_mode = confirm_mode
+        self.prefetch_count = prefetch_count
+        self.ack_batch_size = ack_batch_size
+        self.queue_arguments = queue_arguments or {}
+        self.consume_queue = None
+        self.on_batch = None
+        self.closed = False
+        # Handlers fora da thread de despacho, compartilhada por todas as filas;
+        # in_flight guarda as entregas ainda sem ack (protegido pelo broker)
+        self.delivery_worker = DeliveryWorker(f"inprocess-{owner_id[:8]}")
+        self.in_flight = set()
+
+    @property
+    def is_open(self) -> bool:
+        return not self.closed
+
+    def declare_queue(self, queue_name: str):
+        self.broker.declare_queue(queue_name, self.queue_arguments)
+
+    def publish(self, queue_name: str, body: str) -> Future:
+        return self._publish_with(self.broker.publish_multi, [queue_name], body)
+
+    def _publish_with(self, publish: Callable, target, body: str) -> Future:
+        future = Future()
+        try:
+            publish(target, body, sync=self.confirm_mode, arguments=self.queue_arguments)
+            future.set_result(True)
+        except Exception as e:
+            print(f"Erro ao enviar mensagem assíncrona: {e}")
+            future.set_result(False)
+        return future
+
+    def publish_multi(self, queue_names: List[str], body: str) -> Future:
+        return self._publish_with(self.broker.publish_multi, queue_names, body)
+
+    def publish_topic(self, routing_key: str, body: str) -> Future:
+        return self._publish_with(self.broker.publish_topic, routing_key, body)
+
+    def bind_topic(self, queue_name: str, routing_key: str):
+        self.broker.bind_topic(queue_name, routing_key, self.queue_arguments)
+
+    def unbind_topic(self, queue_name: str, routing_key: str):
+        self.broker.unbind_topic(queue_name, routing_key)
+
+    def flush(self):
+        pass  # No modo confirmado cada publicação já é sincronizada em disco
+
+    def dead_letter_stats(self) -> Dict[str, int]:
+        dead_letter_exchange = self.queue_arguments.get('x-dead-letter-exchange')
+        if not dead_letter_exchange:
+            return {reason: 0 for reason in DEAD_LETTER_REASONS}
+        return self.broker.get_dead_letter_stats(dead_letter_exchange)
+
+    def start_consuming(self, queue_name: str, on_batch: Callable) -> bool:
+        self.consume_queue = queue_name
+        self.on_batch = on_batch
+        return self.broker.subscribe(queue_name, self)
+
+    def drain(self, queue_name: str, on_batch: Callable, max_messages: int = None, timeout: float = 60.0) -> int:
+        return self.broker.drain(queue_name, self, on_batch, max_messages)
+
+    def close(self):
+        if self.consume_queue:
+            self.broker.unsubscribe(self.consume_queue, self)
+        # Espera os lotes em andamento; o que sobrar sem ack volta para a fila
+        self.delivery_worker.stop()
+        if self.consume_queue:
+            self.broker.requeue_in_flight(self.consume_queue, self)
+        self.closed = True
+
+
+class InProcessBroker(BrokerBackend):
+    """Broker em processo, thread-safe, com filas duráveis em arquivos locais.
+
+    Substitui o RabbitMQ em testes de carga e benchmarks do caminho
+    assíncrono. Uma única thread de despacho atende, em rodízio, todas as
+    filas com consumidor, respeitando prefetch_count e passando lotes de até
+    ack_batch_size mensagens ao worker de cada sessão. Como no RabbitMQBroker,
+    as mensagens descartadas ficam em filas duráveis por motivo e as
+    estatísticas são quantas delas estão retidas.
+    """
+
+    name = "inprocess"
+
+    def __init__(self, data_dir: str = None, fsync: bool = False, dead_letter_max_length: int = 10000):
+        self.data_dir = data_dir or os.path.join(tempfile.gettempdir(), "comunicacao_broker")
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.fsync = fsync
+        self.dead_letter_max_length = dead_letter_max_length
+        self.dead_letter_exchanges = set()
+        self.queues: Dict[str, InProcessQueue] = {}
+        # Bindings da exchange de grupos: padrão topic -> filas
+        self.topic_bindings: Dict[str, set] = {}
+        self.condition = threading.Condition()
+        self.dispatch_thread = None
+        # Round-robin: cada varredura começa na fila seguinte à última atendida
+        self.next_queue_index = 0
+        self.published = 0
+        self.delivered = 0
+
+    def open_session(self, owner_id: str, **options) -> InProcessSession:
+        return InProcessSession(self, owner_id, **options)
+
+    def _get_queue(self, queue_name: str, arguments: dict = None) -> InProcessQueue:
+        # Chamado com self.condition adquirida; como no AMQP, os argumentos
+        # valem a partir da primeira declaração da fila
+        q = self.queues.get(queue_name)
+        if q is None:
+            safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in queue_name)
+            q = InProcessQueue(queue_name, os.path.join(self.data_dir, f"{safe_name}.log"), self.fsync, arguments,
+                               self._route_dead_letters)
+            self.queues[queue_name] = q
+        return q
+
+    def _get_dead_letter_queue(self, exchange: str, reason: str) -> InProcessQueue:
+        # Chamado com self.condition adquirida
+        self.dead_letter_exchanges.add(exchange)
+        return self._get_queue(self.dead_letter_queue(exchange, reason),
+                               {'x-max-length': self.dead_letter_max_length})
+
+    def _route_dead_letters(self, exchange: str, reason: str, bodies: List[str]):
+        # Chamado pelas filas com self.condition adquirida; as filas de
+        # dead-letter não têm exchange própria, então o que excede o limite some
+        q = self._get_dead_letter_queue(exchange, reason)
+        for body in bodies:
+            q.append(body)
+
+    def declare_queue(self, queue_name: str, arguments: dict = None):
+        with self.condition:
+            self._get_queue(queue_name, arguments)
+
+    def publish(self, queue_name: str, body: str, sync: bool = False, arguments: dict = None):
+        self.publish_multi([queue_name], body, sync, arguments)
+
+    def publish_multi(self, queue_names: List[str], body: str, sync: bool = False, arguments: dict = None):
+        """Enfileira a mesma mensagem em várias filas com uma única aquisição do lock"""
+        with self.condition:
+            self._append(set(queue_names), body, sync, arguments)
+
+    def publish_topic(self, routing_key: str, body: str, sync: bool = False, arguments: dict = None):
+        with self.condition:
+            queue_names = set()
+            for pattern, bound in self.topic_bindings.items():
+                if self._topic_matches(pattern, routing_key):
+                    queue_names.update(bound)
+            self._append(queue_names, body, sync, arguments)
+
+    def _append(self, queue_names: set, body: str, sync: bool, arguments: dict):
+        # Chamado com self.condition adquirida
+        for queue_name in queue_names:
+            q = self._get_queue(queue_name, arguments)
+            q.append(body)
+            if sync and not self.fsync:
+                q.sync()
+        self.published += 1
+        self.condition.notify()
+
+    def bind_topic(self, queue_name: str, pattern: str, arguments: dict = None):
+        with self.condition:
+            self._get_queue(queue_name, arguments)
+            self.topic_bindings.setdefault(pattern, set()).add(queue_name)
+
+    def unbind_topic(self, queue_name: str, pattern: str):
+        with self.condition:
+            self.topic_bindings.get(pattern, set()).discard(queue_name)
+
+    @staticmethod
+    def _topic_matches(pattern: str, routing_key: str) -> bool:
+        """Casamento AMQP topic: '*' casa uma palavra e '#' zero ou mais"""
+        words = routing_key.split('.')
+
+        def match(p: List[str], w: List[str]) -> bool:
+            if not p:
+                return not w
+            if p[0] == '#':
+                return any(match(p[1:], w[i:]) for i in range(len(w) + 1))
+            return bool(w) and (p[0] == '*' or p[0] == w[0]) and match(p[1:], w[1:])
+
+        return match(pattern.split('.'), words)
+
+    def subscribe(self, queue_name: str, session: InProcessSession) -> bool:
+        with self.condition:
+            q = self._get_queue(queue_name, session.queue_arguments)
+            if q.consumer is not None:
+                return False
+            q.consumer = session
+            if self.dispatch_thread is None:
+                self.dispatch_thread = threading.Thread(target=self._dispatch_loop, name="inprocess-broker")
+                self.dispatch_thread.daemon = True
+                self.dispatch_thread.start()
+            self.condition.notify()
+            return True
+
+    def drain(self, queue_name: str, session: InProcessSession, on_batch: Callable, max_messages: int = None) -> int:
+        """Entrega de uma vez as mensagens prontas da fila, fora do despachante"""
+        with self.condition:
+            q = self._get_queue(queue_name, session.queue_arguments)
+            q.expire()
+            size = len(q.ready) if max_messages is None else min(len(q.ready), max_messages)
+            batch = [q.ready.popleft() for _ in range(size)]
+            for seq, body, expires_at in batch:
+                q.unacked[seq] = (body, expires_at)
+        if not batch:
+            return 0
+
+        outcomes = _run_batch_handler(on_batch, [body for _, body, _ in batch])
+        with self.condition:
+            self._settle_outcomes(q, [seq for seq, _, _ in batch], outcomes)
+        return len(batch)
+
+    def _settle_outcomes(self, q: InProcessQueue, seqs: List[int], outcomes: List[str]):
+        # Chamado com self.condition adquirida
+        by_outcome = {DELIVERY_ACK: [], DELIVERY_REJECT: [], DELIVERY_REQUEUE: []}
+        for seq, outcome in zip(seqs, outcomes):
+            by_outcome[outcome].append(seq)
+        q.settle(by_outcome[DELIVERY_ACK])
+        q.settle(by_outcome[DELIVERY_REJECT], 'rejected')
+        q.requeue(by_outcome[DELIVERY_REQUEUE])
+        self.delivered += len(seqs) - len(by_outcome[DELIVERY_REQUEUE])
+        self.condition.notify()
+
+    def unsubscribe(self, queue_name: str, session: InProcessSession):
+        with self.condition:
+            q = self.queues.get(queue_name)
+            if q and q.consumer is session:
+                q.consumer = None
+
+    def requeue_in_flight(self, queue_name: str, session: InProcessSession):
+        with self.condition:
+            q = self.queues.get(queue_name)
+            if q:
+                q.requeue(session.in_flight)
+            session.in_flight.clear()
+            self.condition.notify()
+
+    def _next_batch(self):
+        queues = list(self.queues.values())
+        for offset in range(len(queues)):
+            index = (self.next_queue_index + offset) % len(queues)
+            q = queues[index]
+            session = q.consumer
+            if not session:
+                continue
+            q.expire()
+            if not q.ready:
+                continue
+            capacity = session.prefetch_count - len(q.unacked) if session.prefetch_count else len(q.ready)
+            size = min(len(q.ready), session.ack_batch_size, capacity)
+            if size <= 0:
+                continue
+            batch = [q.ready.popleft() for _ in range(size)]
+            for seq, body, expires_at in batch:
+                q.unacked[seq] = (body, expires_at)
+                session.in_flight.add(seq)
+            self.next_queue_index = index + 1
+            return q, session, batch
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self.condition:
+                work = self._next_batch()
+                while work is None:
+                    self.condition.wait()
+                    work = self._next_batch()
+
+            q, session, batch = work
+            try:
+                session.delivery_worker.submit(self._deliver, q, session, batch)
+            except RuntimeError:
+                # Sessão encerrada entre a seleção do lote e a entrega
+                with self.condition:
+                    seqs = {seq for seq, _, _ in batch} & session.in_flight
+                    session.in_flight -= seqs
+                    q.requeue(seqs)
+
+    def _deliver(self, q: InProcessQueue, session: InProcessSession, batch: list):
+        """Executa no worker da sessão e confirma cada mensagem conforme o resultado"""
+        outcomes = _run_batch_handler(session.on_batch, [body for _, body, _ in batch])
+        with self.condition:
+            # Entregas já devolvidas à fila pelo fechamento da sessão não contam
+            settled = [(seq, outcome) for (seq, _, _), outcome in zip(batch, outcomes)
+                       if seq in session.in_flight]
+            session.in_flight.difference_update(seq for seq, _ in settled)
+            # Também libera o prefetch da fila para o despachante
+            self._settle_outcomes(q, [seq for seq, _ in settled], [outcome for _, outcome in settled])
+
+    def get_dead_letter_stats(self, dead_letter_exchange: str = None) -> Dict[str, int]:
+        """Mensagens retidas nas filas de dead-letter (de uma exchange ou de todas)"""
+        with self.condition:
+            for q in list(self.queues.values()):
+                q.expire()
+            exchanges = {dead_letter_exchange} if dead_letter_exchange else set(self.dead_letter_exchanges)
+            totals = {reason: 0 for reason in DEAD_LETTER_REASONS}
+            for exchange in exchanges:
+                for reason in DEAD_LETTER_REASONS:
+                    totals[reason] += len(self._get_dead_letter_queue(exchange, reason).ready)
+            return totals
+
+    def get_stats(self) -> Dict[str, dict]:
+        with self.condition:
+            stats = {}
+            # expire() pode criar filas de dead-letter durante a varredura
+            for name, q in list(self.queues.items()):
+                q.expire()
+                stats[name] = {'ready': len(q.ready), 'unacked': len(q.unacked),
+                               'consumer': q.consumer.owner_id if q.consumer else None,
+                               'dead_letters': dict(q.dead_letters)}
+            return stats
+
+
+_default_broker = None
+_default_broker_lock = threading.Lock()
+
+
+def get_default_broker() -> BrokerBackend:
+    """Retorna o broker padrão do processo (RabbitMQ sobre conexões compartilhadas)"""
+    global _default_broker
+    with _default_broker_lock:
+        if _default_broker is None:
+            _default_broker = RabbitMQBroker()
+        return _default_broker
+
+
+class MOMCommunication:
+    def __init__(self, user: User, central_server: CentralServer, confirm_mode: bool = False,
+                 confirm_batch_size: int = 100, confirm_interval_ms: int = 0,
+                 confirm_timeout: float = 10.0, prefetch_count: int = 100,
+                 ack_batch_size: int = 50, ack_interval_ms: int = 0,
+                 connection_manager: AMQPConnectionManager = None, broker: BrokerBackend = None,
+                 queue_max_length: Optional[int] = 10000,
+                 message_ttl_ms: Optional[int] = 7 * 24 * 3600 * 1000,
+                 dead_letter_exchange: Optional[str] = "mom.dead_letter",
+                 exchange: str = "mom.direct", group_exchange: str = "mom.groups"):
+        self.user = user
+        self.central_server = central_server
+        if broker is None:
+            broker = RabbitMQBroker(connection_manager) if connection_manager else get_default_broker()
+        self.broker = broker
+        self.session = None
+        self.connect_lock = threading.Lock()
+        self.confirm_mode = confirm_mode
+        self.confirm_timeout = confirm_timeout
+        # Ajustes de publicação e consumo repassados à sessão do broker
+        self.session_options = {
+            'confirm_mode': confirm_mode,
+            'confirm_batch_size': confirm_batch_size,
+            'confirm_interval_ms': confirm_interval_ms,
+            'prefetch_count': prefetch_count,
+            'ack_batch_size': ack_batch_size,
+            'ack_interval_ms': ack_interval_ms,
+            'queue_arguments': self._queue_arguments(queue_max_length, message_ttl_ms, dead_letter_exchange),
+            'exchange': exchange,
+            'group_exchange': group_exchange
+        }
+        self.consuming = False
+        self.last_drain_stats = None
+        self.message_handler = None
+        self.batch_message_handler = None
+
+    @staticmethod
+    def _queue_arguments(max_length: Optional[int], ttl_ms: Optional[int], dead_letter_exchange: Optional[str]) -> dict:
+        """Argumentos das filas user_<id>, iguais para quem publica e quem consome.
+
+        Filas já existentes no RabbitMQ com outros argumentos precisam ser
+        removidas antes, pois a redeclaração divergente é recusada pelo broker."""
+        arguments = {}
+        if max_length is not None:
+            # Com a fila cheia, a mensagem mais antiga é descartada
+            arguments['x-max-length'] = max_length
+            arguments['x-overflow'] = 'drop-head'
+        if ttl_ms is not None:
+            arguments['x-message-ttl'] = ttl_ms
+        if dead_letter_exchange:
+            arguments['x-dead-letter-exchange'] = dead_letter_exchange
+        return arguments
+
+    def set_message_handler(self, handler: Callable):
+        """Define handler(sender, message, msg_type, message_id, sender_id) para mensagens recebidas"""
+        self.message_handler = handler
+
+    def set_batch_message_handler(self, handler: Callable):
+        """Define handler que recebe lotes [(sender, message, msg_type, message_id, sender_id), ...].
+        Quando definido, tem precedência sobre o handler por mensagem. Pode
+        retornar o resultado de cada mensagem (DELIVERY_ACK, _REJECT ou
+        _REQUEUE); None confirma o lote inteiro."""
+        self.batch_message_handler = handler
+
+    def connect(self):
+        with self.connect_lock:
+            if self.session and self.session.is_open:
+                return True
+
+            if self.session:
+                if self.session.is_recovering:
+                    # A própria sessão restaura canais e consumidor ao reconectar
                     return False
+                # Fecha a sessão morta antes de abrir outra, para não deixar
+                # listeners de reconexão nem consumidores órfãos
+                self.session.close()
+                self.session = None
 
-            target_user = self.central_server.get_user(target_user_id)
-            if not target_user:
+            self.session = self.broker.open_session(self.user.id, **self.session_options)
+            if not self.session:
+                return False
+            try:
+                self.session.declare_queue(f"user_{self.user.id}")
+                if self.consuming:
+                    # O consumo da sessão anterior continua na nova
+                    self.session.start_consuming(f"user_{self.user.id}", self._on_batch)
+                return True
+            except Exception as e:
+                print(f"Erro ao declarar fila do usuário: {e}")
                 return False
 
-            message_data = {
-                'sender': self.user.name,
-                'sender_id': self.user.id,
-                'message': message,
-                'timestamp': datetime.now().isoformat(),
-                'type': 'asynchronous'
-            }
+    def _build_message(self, message: str, group: str = None, message_id: str = None) -> str:
+        message_data = {
+            'message_id': message_id or str(uuid.uuid4()),
+            'sender': self.user.name,
+            'sender_id': self.user.id,
+            'message': message,
+            'timestamp': datetime.now().isoformat(),
+            'type': 'asynchronous'
+        }
+        if group:
+            message_data['group'] = group
+        return json.dumps(message_data)
 
-            queue_name = f"user_{target_user_id}"
-            self.channel.queue_declare(queue=queue_name, durable=True)
+    def send_async_message(self, target_user_id: str, message: str, retry: bool = True,
+                           message_id: str = None) -> bool:
+        target_user = self.central_server.get_user(target_user_id)
+        if not target_user:
+            return False
+        message_id = message_id or str(uuid.uuid4())
 
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=queue_name,
-                body=json.dumps(message_data),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
+        try:
+            delivered = self.publish_confirmed(target_user_id, message, message_id).result(timeout=self.confirm_timeout)
+        except Exception as e:
+            print(f"Mensagem assíncrona sem confirmação do broker: {e}")
+            delivered = False
 
+        if delivered:
             print(f"Mensagem assíncrona enviada para {target_user.name}")
             return True
 
+        # Uma única nova tentativa, com canal (e conexão, se preciso) recriados
+        if retry and not self.confirm_mode:
+            # O mesmo ID torna a nova tentativa segura caso a primeira tenha chegado
+            return self.send_async_message(target_user_id, message, retry=False, message_id=message_id)
+        return False
+
+    def publish_confirmed(self, target_user_id: str, message: str, message_id: str = None) -> Future:
+        """Publica sem aguardar o broker.
+
+        O Future resolve com True quando a publicação é aceita ou, no modo
+        confirmado, quando o lote que contém a mensagem é confirmado; False se
+        falhar (no modo confirmado o broker descarta a transação inteira, então
+        o chamador pode reenviar sem gerar duplicatas)."""
+        if not self.central_server.get_user(target_user_id) or not self.connect():
+            future = Future()
+            future.set_result(False)
+            return future
+
+        return self.session.publish(f"user_{target_user_id}", self._build_message(message, message_id=message_id))
+
+    def send_async_multicast(self, target_user_ids: List[str], message: str) -> bool:
+        """Envia a mesma mensagem assíncrona a vários usuários com uma única publicação"""
+        target_user_ids = list(dict.fromkeys(target_user_ids))
+        try:
+            delivered = self.publish_multicast(target_user_ids, message).result(timeout=self.confirm_timeout)
         except Exception as e:
-            print(f"Erro ao enviar mensagem assíncrona: {e}")
-            try:
-                if self.connect():
-                    return self.send_async_message(target_user_id, message)
-            except:
-                pass
+            print(f"Mensagem assíncrona sem confirmação do broker: {e}")
+            delivered = False
+
+        if delivered:
+            print(f"Mensagem assíncrona enviada para {len(target_user_ids)} usuários")
+        return delivered
+
+    def publish_multicast(self, target_user_ids: List[str], message: str, message_id: str = None) -> Future:
+        """Como publish_confirmed, mas a exchange replica a mensagem para cada destino"""
+        queue_names = [f"user_{target_id}" for target_id in dict.fromkeys(target_user_ids)
+                       if self.central_server.get_user(target_id)]
+        if not queue_names or not self.connect():
+            future = Future()
+            future.set_result(False)
+            return future
+
+        return self.session.publish_multi(queue_names, self._build_message(message, message_id=message_id))
+
+    def join_group(self, group: str) -> bool:
+        """Vincula a fila do usuário à exchange de grupos"""
+        if not self.connect():
+            return False
+        try:
+            self.session.bind_topic(f"user_{self.user.id}", f"group.{group}")
+            return True
+        except Exception as e:
+            print(f"Erro ao entrar no grupo {group}: {e}")
             return False
 
-    def start_consuming(self):
+    def leave_group(self, group: str) -> bool:
+        if not self.connect():
+            return False
+        try:
+            self.session.unbind_topic(f"user_{self.user.id}", f"group.{group}")
+            return True
+        except Exception as e:
+            print(f"Erro ao sair do grupo {group}: {e}")
+            return False
+
+    def send_group_message(self, group: str, message: str) -> bool:
+        """Publica uma vez para todos os membros do grupo, online ou não"""
+        if not self.connect():
+            return False
+        try:
+            delivered = self.session.publish_topic(
+                f"group.{group}", self._build_message(message, group)
+            ).result(timeout=self.confirm_timeout)
+        except Exception as e:
+            print(f"Mensagem de grupo sem confirmação do broker: {e}")
+            delivered = False
+
+        if delivered:
+            print(f"Mensagem assíncrona enviada para o grupo {group}")
+        return delivered
+
+    def flush_confirms(self):
+        """Confirma imediatamente o lote pendente"""
+        if self.session:
+            self.session.flush()
+
+    def start_consuming(self, drain_backlog: bool = False):
+        """Inicia o consumo da fila do usuário.
+
+        Com drain_backlog, as mensagens acumuladas enquanto o usuário estava
+        offline são entregues antes como um único lote ordenado."""
         if not self.connect():
             return
 
-        queue_name = f"user_{self.user.id}"
+        if drain_backlog and not self.consuming:
+            self.drain_backlog()
 
-        def callback(ch, method, properties, body):
-            try:
-                message_data = json.loads(body.decode('utf-8'))
-
-                # Chamar handler personalizado se definido
-                if self.message_handler:
-                    self.message_handler(
-                        message_data.get('sender', 'Desconhecido'),
-                        message_data.get('message', ''),
-                        'async'
-                    )
-                else:
-                    # Fallback para console
-                    print(f"\n[MENSAGEM ASSÍNCRONA] {message_data.get('sender', 'Desconhecido')} -> {self.user.name}")
-                    print(f"Conteúdo: {message_data.get('message', '')}")
-                    print(f"Enviada em: {message_data.get('timestamp', '')}")
+        try:
+            started = self.session.start_consuming(f"user_{self.user.id}", self._on_batch)
+        except Exception as e:
+            print(f"Erro ao iniciar consumo de mensagens assíncronas: {e}")
+            return
 
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+        if started:
+            self.consuming = True
+            print(f"Iniciado consumo de mensagens assíncronas para {self.user.name}")
+
+    def drain_backlog(self, max_messages: int = None) -> dict:
+        """Entrega o backlog da fila de uma vez e registra a taxa de drenagem"""
+        start = time.perf_counter()
+        try:
+            count = self.session.drain(f"user_{self.user.id}", self._on_batch, max_messages)
+        except Exception as e:
+            print(f"Erro ao drenar backlog de mensagens assíncronas: {e}")
+            count = 0
+        elapsed = time.perf_counter() - start
+
+        self.last_drain_stats = {
+            'messages': count,
+            'seconds': elapsed,
+            'rate': count / elapsed if elapsed > 0 else 0.0
+        }
+        if count:
+            print(f"Backlog de {count} mensagens drenado em {elapsed * 1000:.1f} ms "
+                  f"({self.last_drain_stats['rate']:.0f} msg/s)")
+        return self.last_drain_stats
+
+    def _on_batch(self, bodies: list) -> List[str]:
+        """Decodifica um lote entregue pelo broker, repassa aos handlers e
+        retorna o resultado de cada mensagem (DELIVERY_ACK, _REJECT ou _REQUEUE)"""
+        outcomes = [DELIVERY_ACK] * len(bodies)
+        batch = []  # (posição no lote, dados)
+        for index, body in enumerate(bodies):
+            try:
+                if isinstance(body, bytes):
+                    body = body.decode('utf-8')
+                data = json.loads(body)
             except Exception as e:
+                # Mensagem malformada vai para o dead-letter para evitar loop infinito
                 print(f"Erro ao processar mensagem assíncrona: {e}")
-                # Rejeitar mensagem em caso de erro para evitar loop infinito
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                outcomes[index] = DELIVERY_REJECT
+                continue
+            # Mensagens de grupo também chegam à fila do próprio remetente
+            if not (data.get('group') and data.get('sender_id') == self.user.id):
+                batch.append((index, data))
+        if not batch:
+            return outcomes
+
+        messages = [
+            (data.get('sender', 'Desconhecido'), data.get('message', ''), 'async', data.get('message_id'),
+             data.get('sender_id'))
+            for _, data in batch
+        ]
+
+        # Chamar handler personalizado se definido
+        if self.batch_message_handler:
+            try:
+                results = self.batch_message_handler(messages)
+            except Exception as e:
+                print(f"Erro ao processar lote de mensagens assíncronas: {e}")
+                results = [DELIVERY_REJECT] * len(messages)
+            for (index, _), result in zip(batch, results or []):
+                outcomes[index] = result
+        elif self.message_handler:
+            # Cada mensagem tem o próprio resultado: um erro no meio do lote
+            # não rejeita as que já foram processadas
+            for (index, _), item in zip(batch, messages):
+                try:
+                    self.message_handler(*item)
+                except Exception as e:
+                    print(f"Erro ao processar mensagem assíncrona: {e}")
+                    outcomes[index] = DELIVERY_REJECT
+        else:
+            # Fallback para console
+            for _, data in batch:
+                print(f"\n[MENSAGEM ASSÍNCRONA] {data.get('sender', 'Desconhecido')} -> {self.user.name}")
+                print(f"Conteúdo: {data.get('message', '')}")
+                print(f"Enviada em: {data.get('timestamp', '')}")
+        return outcomes
+
+    def get_dead_letter_stats(self) -> Dict[str, int]:
+        """Mensagens descartadas pelas filas por motivo: maxlen, expired e rejected"""
+        if self.session and self.session.is_open:
+            return self.session.dead_letter_stats()
+        return self.broker.get_dead_letter_stats()
 
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(
-            queue=queue_name,
-            on_message_callback=callback
-        )
+    def stop_consuming(self):
+        if self.session:
+            self.session.close()
+        self.session = None
+        self.consuming = False
 
-        self.consuming = True
 
-        def consume_loop():
-            while self.consuming and self.connection and not self.connection.is_closed:
-                try:
-                    self.connection.process_data_events(time_limit=1)
-                except Exception as e:
-                    print(f"Erro no loop de consumo: {e}")
-                    break
+class TransportCircuitBreaker:
+    """Estado de saúde de um transporte (socket ou RPC) para um destino"""
 
-        self.consume_thread = threading.Thread(target=consume_loop)
-        self.consume_thread.daemon = True
-        self.consume_thread.start()
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
 
-        print(f"Iniciado consumo de mensagens assíncronas para {self.user.name}")
+    def __init__(self, failure_threshold: int = 1, backoff: float = 5.0, max_backoff: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.current_backoff = backoff
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
 
-    def stop_consuming(self):
-        self.consuming = False
-        try:
-            if self.connection and not self.connection.is_closed:
-                self.connection.close()
-        except:
-            pass
+    def allow_request(self) -> bool:
+        """Indica se o transporte pode ser tentado agora"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.monotonic() - self.opened_at >= self.current_backoff):
+                # Backoff expirado: libera uma única tentativa de sondagem
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.current_backoff = self.base_backoff
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN:
+                # Sonda falhou: reabre com backoff exponencial
+                self.current_backoff = min(self.current_backoff * 2, self.max_backoff)
+                self._open()
+            elif self.consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    def to_dict(self):
+        with self.lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0.0, self.current_backoff - (time.monotonic() - self.opened_at))
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'backoff': self.current_backoff,
+                'retry_in': retry_in
+            }
+
+
+class MessageDeduplicator:
+    """Cache limitado de IDs de mensagens recebidas dentro de uma janela de tempo.
+
+    Uma mensagem repetida (reenvio após ack perdido, hedge ou fallback para
+    o MOM) é reconhecida enquanto o ID estiver na janela; IDs mais antigos que
+    window_seconds, ou além de max_entries, são descartados.
+    """
+
+    def __init__(self, window_seconds: float = 300.0, max_entries: int = 10000):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.seen: OrderedDict = OrderedDict()  # message_id -> instante do primeiro recebimento
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, message_id: str) -> bool:
+        """Registra o ID e indica se a mensagem já foi entregue"""
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if message_id in self.seen:
+                self.duplicates += 1
+                return True
+            self.seen[message_id] = now
+            if len(self.seen) > self.max_entries:
+                self.seen.popitem(last=False)
+            return False
+
+    def forget(self, message_ids: List[str]):
+        """Remove IDs registrados de mensagens que não chegaram a ser entregues"""
+        with self.lock:
+            for message_id in message_ids:
+                self.seen.pop(message_id, None)
+
+    def _expire(self, now: float):
+        while self.seen:
+            oldest_id, received_at = next(iter(self.seen.items()))
+            if now - received_at <= self.window_seconds:
+                break
+            del self.seen[oldest_id]
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {'tracked_ids': len(self.seen), 'duplicates': self.duplicates}
 
 
 class CommunicationManager:
-    def __init__(self, user: User, central_server: CentralServer):
+    def __init__(self, user: User, central_server: CentralServer,
+                 breaker_failure_threshold: int = 1, breaker_backoff: float = 5.0,
+                 breaker_max_backoff: float = 60.0, hedged_delivery: bool = False,
+                 hedge_delay: float = 0.05, outbound_workers: int = 4,
+                 outbound_batch_size: int = 50, mom_options: dict = None,
+                 dispatch_workers: int = 2, dispatch_queue_size: int = 1000,
+                 dispatch_put_timeout: float = 1.0,
+                 broadcast_workers: int = 16, broadcast_timeout: float = 10.0,
+                 dedup_window: float = 300.0, dedup_max_entries: int = 10000,
+                 port_allocator: PortAllocator = None):
         self.user = user
         self.central_server = central_server
         self.socket_comm = SocketCommunicationServer(user, central_server)
         self.rpc_client = RPCClient(user, central_server)
         self.rpc_service = None
-        self.mom_comm = MOMCommunication(user, central_server)
+        self.mom_comm = MOMCommunication(user, central_server, **(mom_options or {}))
         self.rpc_daemon = None
+        # Portas fixas não são mais necessárias: porta 0 (efêmera) ou, se
+        # informado, uma porta do intervalo gerenciado pelo alocador
+        self.port_allocator = port_allocator
+        self.allocated_ports = []
         self.message_handlers = []  # Lista de handlers para mensagens recebidas
+        self.contact_listeners = []  # Handlers de eventos de mudança nos contatos
+        self.batch_message_handlers = []  # Handlers que recebem lotes de mensagens
+        # Circuit breakers por (destino, transporte)
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.breaker_backoff = breaker_backoff
+        self.breaker_max_backoff = breaker_max_backoff
+        self.transport_breakers: Dict[Tuple[str, str], TransportCircuitBreaker] = {}
+        self.breakers_lock = threading.Lock()
+        # Entrega com hedge: dispara RPC se o socket não confirmar em hedge_delay segundos
+        self.hedged_delivery = hedged_delivery
+        self.hedge_delay = hedge_delay
+        # IDs recentes para descartar cópias entregues por mais de um transporte
+        self.deduplicator = MessageDeduplicator(dedup_window, dedup_max_entries)
+        # Envios não bloqueantes (send_async): uma fila FIFO por destino e um pool
+        # de workers; outbound_queue contém os destinos com mensagens pendentes
+        self.outbound_queue = queue.Queue()
+        self.target_queues: Dict[str, deque] = {}
+        self.scheduled_targets = set()
+        self.outbound_workers = outbound_workers
+        self.outbound_batch_size = outbound_batch_size
+        self.outbound_threads = []
+        self.outbound_lock = threading.Lock()
+        # Após stop_services, novos envios falham em vez de reiniciar os workers
+        self.outbound_stopped = False
+        # broadcast_area usa um pool próprio por chamada, sem ocupar os workers
+        # de saída, e não espera mais que broadcast_timeout pelos envios síncronos
+        self.broadcast_workers = broadcast_workers
+        self.broadcast_timeout = broadcast_timeout
+        # Despacho dos handlers fora das threads de rede: uma fila limitada por
+        # worker e cada remetente (por sender_id) sempre no mesmo worker,
+        # preservando a ordem. Com a fila cheia, as threads de socket/RPC (uma
+        # por conexão) esperam (backpressure); o worker de entrega do MOM espera
+        # até dispatch_put_timeout segundos e devolve ao broker (requeue) as
+        # mensagens que não couberam, contadas em get_dispatch_stats()['requeued'];
+        # enquanto isso o prefetch da sessão segura novas entregas. Como no
+        # requeue do AMQP, a reentrega pode chegar depois de lotes já
+        # pré-buscados. Com dispatch_workers = 0 os handlers rodam na própria
+        # thread de rede
+        self.dispatch_workers = dispatch_workers
+        self.dispatch_queue_size = dispatch_queue_size
+        self.dispatch_put_timeout = dispatch_put_timeout
+        self.dispatch_queues: List[queue.Queue] = []
+        self.dispatch_threads = []
+        self.dispatch_lock = threading.Lock()
+        self.dispatch_stats = {'messages': 0, 'batches': 0, 'wait_time': 0.0,
+                               'handler_time': 0.0, 'max_handler_time': 0.0, 'max_depth': 0,
+                               'requeued': 0}
 
     def add_message_handler(self, handler: Callable):
         """Adiciona handler para mensagens recebidas"""
         self.message_handlers.append(handler)
 
-    def _handle_received_message(self, sender: str, message: str, msg_type: str):
+    def add_contact_listener(self, listener: Callable):
+        """Adiciona listener(events) notificado quando os contatos mudam"""
+        if not self.contact_listeners:
+            self.central_server.subscribe(self.user.id, self._on_contact_events)
+        self.contact_listeners.append(listener)
+
+    def remove_contact_listener(self, listener: Callable):
+        if listener in self.contact_listeners:
+            self.contact_listeners.remove(listener)
+            if not self.contact_listeners:
+                self.central_server.unsubscribe(self.user.id, self._on_contact_events)
+
+    def _on_contact_events(self, events: List[dict]):
+        for listener in list(self.contact_listeners):
+            try:
+                listener(events)
+            except Exception as e:
+                print(f"Erro em contact listener: {e}")
+
+    def add_batch_message_handler(self, handler: Callable):
+        """Adiciona handler que recebe cada entrega como lista [(sender, message, msg_type), ...]"""
+        self.batch_message_handlers.append(handler)
+
+    def _handle_received_message(self, sender: str, message: str, msg_type: str, message_id: str = None,
+                                 sender_id: str = None):
         """Processa mensagem recebida e chama todos os handlers"""
-        for handler in self.message_handlers:
+        self._handle_received_batch([(sender, message, msg_type, message_id, sender_id)], block=True)
+
+    def _handle_received_batch(self, messages: list, block: bool = False) -> List[str]:
+        """Processa um lote de (sender, message, msg_type, message_id, sender_id) recebido de uma vez.
+
+        Retorna o resultado de cada mensagem para o broker. Sem block, espera
+        no máximo dispatch_put_timeout segundos por espaço na fila de despacho;
+        as mensagens que não couberam voltam como DELIVERY_REQUEUE.
+        """
+        timeout = None if block else self.dispatch_put_timeout
+        outcomes = [DELIVERY_ACK] * len(messages)
+        # (posição no lote, sender_id, message_id, item entregue aos handlers)
+        batch = [(index, sender_id or sender, message_id, (sender, message, msg_type))
+                 for index, (sender, message, msg_type, message_id, sender_id) in enumerate(messages)
+                 if not (message_id and self.deduplicator.is_duplicate(message_id))]
+        if not batch:
+            return outcomes
+
+        if not self.dispatch_workers:
+            self._run_handlers([item for _, _, _, item in batch])
+            return outcomes
+
+        dispatch_queues = self._ensure_dispatch_workers()
+        shards = {}
+        for entry in batch:
+            shards.setdefault(hash(entry[1]) % len(dispatch_queues), []).append(entry)
+
+        enqueued_at = time.perf_counter()
+        requeued = []
+        for index, entries in shards.items():
             try:
-                handler(sender, message, msg_type)
+                dispatch_queues[index].put((enqueued_at, [item for _, _, _, item in entries]), timeout=timeout)
+            except queue.Full:
+                requeued.extend(entries)
+
+        if requeued:
+            # Os IDs só ficam registrados para as mensagens de fato enfileiradas;
+            # a reentrega do broker não pode ser tomada por duplicata
+            self.deduplicator.forget([message_id for _, _, message_id, _ in requeued if message_id])
+            for index, _, _, _ in requeued:
+                outcomes[index] = DELIVERY_REQUEUE
+            print(f"Fila de despacho cheia: {len(requeued)} mensagens devolvidas ao broker")
+
+        depth = sum(q.qsize() for q in dispatch_queues)
+        with self.dispatch_lock:
+            self.dispatch_stats['max_depth'] = max(self.dispatch_stats['max_depth'], depth)
+            self.dispatch_stats['requeued'] += len(requeued)
+        return outcomes
+
+    def _run_handlers(self, batch: list):
+        for sender, message, msg_type in batch:
+            for handler in self.message_handlers:
+                try:
+                    handler(sender, message, msg_type)
+                except Exception as e:
+                    print(f"Erro em message handler: {e}")
+
+        for handler in self.batch_message_handlers:
+            try:
+                handler(batch)
             except Exception as e:
-                print(f"Erro em message handler: {e}")
+                print(f"Erro em batch message handler: {e}")
+
+    def _ensure_dispatch_workers(self) -> List[queue.Queue]:
+        with self.dispatch_lock:
+            if self.dispatch_threads:
+                return self.dispatch_queues
+            self.dispatch_queues = [queue.Queue(maxsize=self.dispatch_queue_size)
+                                    for _ in range(self.dispatch_workers)]
+            for i, work_queue in enumerate(self.dispatch_queues):
+                thread = threading.Thread(target=self._dispatch_worker, args=(work_queue,),
+                                          name=f"dispatch-{self.user.name}-{i}")
+                thread.daemon = True
+                thread.start()
+                self.dispatch_threads.append(thread)
+            return self.dispatch_queues
+
+    def _dispatch_worker(self, work_queue: queue.Queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+
+            enqueued_at, messages = item
+            start = time.perf_counter()
+            self._run_handlers(messages)
+            elapsed = time.perf_counter() - start
+
+            with self.dispatch_lock:
+                stats = self.dispatch_stats
+                stats['messages'] += len(messages)
+                stats['batches'] += 1
+                stats['wait_time'] += start - enqueued_at
+                stats['handler_time'] += elapsed
+                stats['max_handler_time'] = max(stats['max_handler_time'], elapsed)
+
+    def _stop_dispatch_workers(self):
+        with self.dispatch_lock:
+            dispatch_queues, self.dispatch_queues = self.dispatch_queues, []
+            self.dispatch_threads = []
+        # Fora do lock: com a fila cheia o put espera o worker liberar espaço,
+        # e o worker precisa do lock para atualizar as estatísticas
+        for work_queue in dispatch_queues:
+            work_queue.put(None)
+
+    def get_dispatch_stats(self) -> dict:
+        """Profundidade das filas de despacho e latência dos handlers (por lote)"""
+        with self.dispatch_lock:
+            stats = dict(self.dispatch_stats)
+            batches = stats['batches'] or 1
+            return {
+                'workers': len(self.dispatch_threads),
+                'queue_depth': sum(q.qsize() for q in self.dispatch_queues),
+                'max_queue_depth': stats['max_depth'],
+                'messages': stats['messages'],
+                'batches': stats['batches'],
+                'avg_wait_ms': stats['wait_time'] / batches * 1000,
+                'avg_handler_ms': stats['handler_time'] / batches * 1000,
+                'max_handler_ms': stats['max_handler_time'] * 1000,
+                'requeued': stats['requeued']
+            }
 
-    def start_services(self, socket_port: int, rpc_port: int):
+    def start_services(self, socket_port: int = 0, rpc_port: int = 0):
+        """Inicia os serviços; portas 0 são atribuídas dinamicamente e publicadas no servidor central"""
         # Configurar handlers para todos os tipos de comunicação
         self.socket_comm.set_message_handler(self._handle_received_message)
         self.mom_comm.set_message_handler(self._handle_received_message)
+        self.mom_comm.set_batch_message_handler(self._handle_received_batch)
+
+        if self.port_allocator:
+            if not socket_port:
+                socket_port = self.port_allocator.allocate()
+                self.allocated_ports.append(socket_port)
+            if not rpc_port:
+                rpc_port = self.port_allocator.allocate()
+                self.allocated_ports.append(rpc_port)
 
         # Iniciar servidor socket
-        self.socket_comm.start_server(socket_port)
+        socket_port = self.socket_comm.start_server(socket_port)
 
         # Iniciar serviço RPC
-        self._start_rpc_service(rpc_port)
+        rpc_port = self._start_rpc_service(rpc_port)
 
         # Conectar com MOM e iniciar consumo
         if self.mom_comm.connect():
-            self.mom_comm.start_consuming()
+            self.mom_comm.start_consuming(drain_backlog=True)
 
-        # Registrar usuário no servidor central
+        # Registrar usuário no servidor central e publicar as portas atribuídas
         self.central_server.register_user(self.user)
+        self.central_server.update_user_endpoints(self.user.id, socket_port, rpc_port)
 
         # Marcar como online
         self.user.set_status("online")
@@ -491,17 +2933,26 @@ class CommunicationManager:
         print(f"Socket: porta {socket_port}")
         print(f"RPC: porta {rpc_port}")
 
-    def _start_rpc_service(self, port: int):
+    def _start_rpc_service(self, port: int = 0) -> Optional[int]:
+        """Cria o daemon Pyro na thread atual para conhecer a porta efetiva
+        antes de publicá-la; apenas o loop de requisições roda em background"""
+        try:
+            daemon = Pyro5.api.Daemon(host="localhost", port=port)
+            self.rpc_service = RPCCommunicationService(self.user, self.central_server)
+            self.rpc_service.set_message_handler(self._handle_received_message)
+            uri = daemon.register(self.rpc_service, "rpc_service")
+        except Exception as e:
+            print(f"Erro no servidor RPC: {e}")
+            self.user.rpc_port = None
+            return None
+
+        self.rpc_daemon = daemon
+        port = daemon.sock.getsockname()[1]
         self.user.rpc_port = port
+        print(f"Serviço RPC registrado: {uri}")
 
         def run_rpc_server():
             try:
-                daemon = Pyro5.api.Daemon(host="localhost", port=port)
-                self.rpc_service = RPCCommunicationService(self.user, self.central_server)
-                self.rpc_service.set_message_handler(self._handle_received_message)
-                uri = daemon.register(self.rpc_service, "rpc_service")
-
-                print(f"Serviço RPC registrado: {uri}")
                 daemon.requestLoop()
             except Exception as e:
                 print(f"Erro no servidor RPC: {e}")
@@ -509,29 +2960,308 @@ class CommunicationManager:
         thread = threading.Thread(target=run_rpc_server)
         thread.daemon = True
         thread.start()
+        return port
 
-    def send_message(self, target_user_id: str, message: str):
+    def send_message(self, target_user_id: str, message: str, hedged: bool = None) -> str:
+        """Envia mensagem e retorna o status de entrega: 'sync', 'async' ou 'failed'"""
         target_user = self.central_server.get_user(target_user_id)
         if not target_user:
             print("Usuário de destino não encontrado")
-            return
+            return "failed"
+
+        if hedged is None:
+            hedged = self.hedged_delivery
+        message_id = str(uuid.uuid4())
 
         # Verificar se deve usar comunicação síncrona ou assíncrona
         if (target_user.status == "online" and
                 self.user.is_in_communication_range(target_user)):
 
-            # Tentar socket primeiro, depois RPC
-            success = self.socket_comm.send_message(target_user_id, message)
-            if not success:
-                success = self.rpc_client.send_message_to_user(target_user_id, message)
+            if hedged:
+                success = self._send_hedged(target_user_id, message, message_id)
+            else:
+                success = self._send_sync(target_user_id, self.socket_comm.send_message,
+                                          self.rpc_client.send_message_to_user, message, message_id)
+
+            if success:
+                return "sync"
 
-            if not success:
-                print("Falha na comunicação síncrona, enviando assíncrona")
-                self.mom_comm.send_async_message(target_user_id, message)
+            print("Falha na comunicação síncrona, enviando assíncrona")
         else:
             # Comunicação assíncrona
             print("Usuário offline ou fora de alcance, enviando mensagem assíncrona")
-            self.mom_comm.send_async_message(target_user_id, message)
+
+        # O fallback reutiliza o ID: se o envio síncrono chegou ao destino
+        # apesar da falha aparente, o receptor descarta a cópia assíncrona
+        if self.mom_comm.send_async_message(target_user_id, message, message_id=message_id):
+            return "async"
+        return "failed"
+
+    def send_batch(self, target_user_id: str, messages: List[str]) -> List[str]:
+        """Envia um lote ordenado para o mesmo destino e retorna o status de cada mensagem"""
+        target_user = self.central_server.get_user(target_user_id)
+        if not target_user:
+            print("Usuário de destino não encontrado")
+            return ["failed"] * len(messages)
+
+        message_ids = [str(uuid.uuid4()) for _ in messages]
+
+        if (target_user.status == "online" and
+                self.user.is_in_communication_range(target_user)):
+            if self._send_sync(target_user_id, self.socket_comm.send_batch,
+                               self.rpc_client.send_batch_to_user, messages, message_ids):
+                return ["sync"] * len(messages)
+
+            print("Falha na comunicação síncrona do lote, enviando assíncrona")
+        else:
+            print("Usuário offline ou fora de alcance, enviando lote assíncrono")
+
+        return ["async" if self.mom_comm.send_async_message(target_user_id, message, message_id=message_id)
+                else "failed" for message, message_id in zip(messages, message_ids)]
+
+    def broadcast_area(self, latitude: float, longitude: float, radius_km: float, message: str,
+                       timeout: float = None) -> Dict[str, str]:
+        """Envia a mensagem a todos os usuários a até radius_km do ponto.
+
+        Os destinatários saem de uma única consulta ao índice espacial. Os
+        online dentro do alcance do remetente recebem por envio síncrono, em
+        paralelo num pool de até broadcast_workers threads criado para a
+        chamada; os demais recebem por uma única publicação multicast no MOM.
+        Destinos que não respondem em timeout segundos (padrão
+        broadcast_timeout) ficam como 'failed'. Retorna o status de entrega
+        por usuário."""
+        sync_targets = []
+        async_targets = []
+        for target_user, _ in self.central_server.query_radius(latitude, longitude, radius_km):
+            if target_user.id == self.user.id:
+                continue
+            if target_user.status == "online" and self.user.is_in_communication_range(target_user):
+                sync_targets.append(target_user.id)
+            else:
+                async_targets.append(target_user.id)
+
+        futures = self._start_broadcast(sync_targets, message)
+
+        statuses = {}
+        if async_targets:
+            status = "async" if self.mom_comm.send_async_multicast(async_targets, message) else "failed"
+            statuses.update(dict.fromkeys(async_targets, status))
+
+        deadline = time.monotonic() + (self.broadcast_timeout if timeout is None else timeout)
+        for target_id, future in futures.items():
+            try:
+                statuses[target_id] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                print(f"Tempo esgotado no envio por área para {target_id}")
+                statuses[target_id] = "failed"
+            except Exception as e:
+                print(f"Erro no envio por área para {target_id}: {e}")
+                statuses[target_id] = "failed"
+        # Envios que nem começaram são cancelados; um destino travado ocupa só
+        # a própria thread (daemon) e não prende o chamador
+        for future in futures.values():
+            future.cancel()
+
+        print(f"Mensagem por área entregue a {len(statuses)} usuários "
+              f"({len(sync_targets)} síncronos, {len(async_targets)} assíncronos)")
+        return statuses
+
+    def _start_broadcast(self, target_ids: List[str], message: str) -> Dict[str, Future]:
+        """Envia a mensagem aos destinos por até broadcast_workers threads próprias"""
+        pending = queue.Queue()
+        futures = {}
+        for target_id in target_ids:
+            futures[target_id] = Future()
+            pending.put(target_id)
+
+        def worker():
+            while True:
+                try:
+                    target_id = pending.get_nowait()
+                except queue.Empty:
+                    return
+                future = futures[target_id]
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(self.send_message(target_id, message))
+                except Exception as e:
+                    future.set_exception(e)
+
+        for i in range(min(self.broadcast_workers, len(target_ids))):
+            thread = threading.Thread(target=worker, name=f"broadcast-{self.user.name}-{i}")
+            thread.daemon = True
+            thread.start()
+        return futures
+
+    def _send_sync(self, target_user_id: str, socket_func: Callable, rpc_func: Callable, *args) -> bool:
+        # Tentar socket primeiro, depois RPC, pulando transportes com circuito aberto
+        if self._try_transport(target_user_id, 'socket', socket_func, *args):
+            return True
+        return self._try_transport(target_user_id, 'rpc', rpc_func, *args)
+
+    def send_async(self, target_user_id: str, message: str, callback: Callable = None) -> Future:
+        """Enfileira o envio sem bloquear o chamador.
+
+        Retorna um Future resolvido com o status de entrega ('sync', 'async'
+        ou 'failed'). Se informado, callback(target_user_id, message, status)
+        é chamado na thread do worker ao final da entrega."""
+        future = Future()
+        if callback:
+            def notify(done_future):
+                status = "failed" if done_future.cancelled() or done_future.exception() else done_future.result()
+                try:
+                    callback(target_user_id, message, status)
+                except Exception as e:
+                    print(f"Erro em callback de entrega: {e}")
+
+            future.add_done_callback(notify)
+
+        self._ensure_outbound_workers()
+        with self.outbound_lock:
+            if self.outbound_stopped:
+                future.set_result("failed")
+                return future
+            self.target_queues.setdefault(target_user_id, deque()).append((message, future))
+            # Cada destino é drenado por um único worker por vez, preservando a ordem
+            if target_user_id not in self.scheduled_targets:
+                self.scheduled_targets.add(target_user_id)
+                self.outbound_queue.put(target_user_id)
+        return future
+
+    def _ensure_outbound_workers(self):
+        with self.outbound_lock:
+            if self.outbound_threads or self.outbound_stopped:
+                return
+            for i in range(self.outbound_workers):
+                thread = threading.Thread(target=self._outbound_worker, name=f"outbound-{self.user.name}-{i}")
+                thread.daemon = True
+                thread.start()
+                self.outbound_threads.append(thread)
+
+    def _outbound_worker(self):
+        while True:
+            target_user_id = self.outbound_queue.get()
+            if target_user_id is None:
+                break
+
+            with self.outbound_lock:
+                pending = self.target_queues.get(target_user_id)
+                if not pending:
+                    # Pendências já resolvidas como falha por _stop_outbound_workers
+                    continue
+                batch = [pending.popleft() for _ in range(min(len(pending), self.outbound_batch_size))]
+
+            self._deliver_batch(target_user_id, batch)
+
+            with self.outbound_lock:
+                if self.target_queues.get(target_user_id):
+                    self.outbound_queue.put(target_user_id)
+                else:
+                    self.target_queues.pop(target_user_id, None)
+                    self.scheduled_targets.discard(target_user_id)
+
+    def _deliver_batch(self, target_user_id: str, batch: list):
+        batch = [(message, future) for message, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            if len(batch) == 1:
+                statuses = [self.send_message(target_user_id, batch[0][0])]
+            else:
+                statuses = self.send_batch(target_user_id, [message for message, _ in batch])
+            for (_, future), status in zip(batch, statuses):
+                future.set_result(status)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _stop_outbound_workers(self):
+        # Destinos recolocados na fila pelos workers ficariam atrás das
+        # sentinelas: as mensagens ainda não enviadas são resolvidas como falha
+        with self.outbound_lock:
+            self.outbound_stopped = True
+            pending = [future for target_queue in self.target_queues.values() for _, future in target_queue]
+            self.target_queues.clear()
+            self.scheduled_targets.clear()
+            for _ in self.outbound_threads:
+                self.outbound_queue.put(None)
+            self.outbound_threads = []
+
+        for future in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_result("failed")
+
+    def _get_breaker(self, target_user_id: str, transport: str) -> TransportCircuitBreaker:
+        key = (target_user_id, transport)
+        with self.breakers_lock:
+            breaker = self.transport_breakers.get(key)
+            if breaker is None:
+                breaker = TransportCircuitBreaker(self.breaker_failure_threshold,
+                                                  self.breaker_backoff,
+                                                  self.breaker_max_backoff)
+                self.transport_breakers[key] = breaker
+            return breaker
+
+    def _try_transport(self, target_user_id: str, transport: str, send_func: Callable, *args) -> bool:
+        """Executa um envio síncrono respeitando o circuit breaker do transporte"""
+        breaker = self._get_breaker(target_user_id, transport)
+        if not breaker.allow_request():
+            print(f"Transporte {transport} indisponível para o destino, pulando")
+            return False
+
+        try:
+            success = send_func(target_user_id, *args)
+        except Exception as e:
+            # Sem registrar a falha, um breaker em HALF_OPEN nunca sairia desse estado
+            print(f"Erro no transporte {transport}: {e}")
+            success = False
+        if success:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        return success
+
+    def _send_hedged(self, target_user_id: str, message: str, message_id: str) -> bool:
+        """Envia por socket e, se não houver confirmação a tempo, também por RPC.
+        O primeiro sucesso vence; o receptor descarta a cópia pelo message_id."""
+        results = queue.Queue()
+
+        def attempt(transport: str, send_func: Callable):
+            try:
+                results.put(self._try_transport(target_user_id, transport, send_func, message, message_id))
+            except Exception as e:
+                print(f"Erro no envio {transport} com hedge: {e}")
+                results.put(False)
+
+        threading.Thread(target=attempt, args=('socket', self.socket_comm.send_message), daemon=True).start()
+        pending = 1
+        try:
+            if results.get(timeout=self.hedge_delay):
+                return True
+            pending -= 1
+        except queue.Empty:
+            pass
+
+        threading.Thread(target=attempt, args=('rpc', self.rpc_client.send_message_to_user), daemon=True).start()
+        pending += 1
+        while pending:
+            if results.get():
+                return True
+            pending -= 1
+        return False
+
+    def get_transport_health(self, target_user_id: str = None) -> Dict[str, Dict[str, dict]]:
+        """Retorna o estado dos circuit breakers, por destino e transporte"""
+        with self.breakers_lock:
+            items = list(self.transport_breakers.items())
+        health = {}
+        for (target_id, transport), breaker in items:
+            if target_user_id is None or target_id == target_user_id:
+                health.setdefault(target_id, {})[transport] = breaker.to_dict()
+        return health
 
     def update_location(self, latitude: float, longitude: float):
         self.user.update_location(latitude, longitude)
@@ -543,26 +3273,31 @@ class CommunicationManager:
         self.central_server.update_user_radius(self.user.id, radius)
         print(f"Raio de comunicação atualizado: {radius} km")
 
+    def update_max_contacts(self, max_contacts: Optional[int]):
+        self.central_server.update_user_max_contacts(self.user.id, max_contacts)
+        print(f"Limite de contatos atualizado: {max_contacts if max_contacts else 'sem limite'}")
+
     def get_contacts_info(self):
-        contacts_info = []
-        for contact_id in self.user.contacts:
-            contact = self.central_server.get_user(contact_id)
-            if contact:
-                distance = self.user.distance_to(contact)
-                contacts_info.append({
-                    'name': contact.name,
-                    'id': contact.id,
-                    'status': contact.status,
-                    'distance': round(distance, 2),
-                    'in_range': self.user.is_in_communication_range(contact)
-                })
-        return contacts_info
+        """Retorna a visão dos contatos já calculada pelo servidor central (somente leitura)"""
+        return list(self.user.contact_snapshot)
 
     def stop_services(self):
         self.user.set_status("offline")
         self.central_server.update_user_status(self.user.id, "offline")
         self.socket_comm.stop_server()
         self.mom_comm.stop_consuming()
+        self._stop_outbound_workers()
+        self._stop_dispatch_workers()
+        if self.rpc_daemon:
+            try:
+                self.rpc_daemon.shutdown()
+            except Exception:
+                pass
+            self.rpc_daemon = None
+        if self.port_allocator:
+            for port in self.allocated_ports:
+                self.port_allocator.release(port)
+            self.allocated_ports = []
 
 
 # Interface de usuário simples (mesma do original)
@@ -679,9 +3414,9 @@ def main():
     comm_manager3 = CommunicationManager(user3, central_server)
 
     # Iniciar serviços
-    comm_manager1.start_services(8001, 9001)
-    comm_manager2.start_services(8002, 9002)
-    comm_manager3.start_services(8003, 9003)
+    comm_manager1.start_services()
+    comm_manager2.start_services()
+    comm_manager3.start_services()
 
     # Aguardar inicialização
     time.sleep(2)
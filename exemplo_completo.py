@@ -3,7 +3,6 @@
 
 from comunicacao_sistema import *
 import time
-import threading
 
 
 def demo_automatica():
@@ -27,10 +26,10 @@ def demo_automatica():
     comm_diana = CommunicationManager(diana, central_server)
 
     # Iniciar serviços
-    comm_alice.start_services(8001, 9001)
-    comm_bob.start_services(8002, 9002)
-    comm_carol.start_services(8003, 9003)
-    comm_diana.start_services(8004, 9004)
+    comm_alice.start_services()
+    comm_bob.start_services()
+    comm_carol.start_services()
+    comm_diana.start_services()
 
     time.sleep(3)
     print("✅ Sistema inicializado com 4 usuários")
@@ -113,14 +112,10 @@ def demo_automatica():
             (comm_diana, alice.id, "Mensagem de Diana para Alice"),
         ]
 
-        threads = []
-        for comm, target_id, message in messages:
-            thread = threading.Thread(target=comm.send_message, args=(target_id, message))
-            threads.append(thread)
-            thread.start()
+        futures = [comm.send_async(target_id, message) for comm, target_id, message in messages]
 
-        for thread in threads:
-            thread.join()
+        for future in futures:
+            print(f"  Status de entrega: {future.result()}")
 
     print("Enviando múltiplas mensagens simultaneamente...")
     enviar_multiplas_mensagens()
@@ -179,21 +174,15 @@ def demo_interativa():
     users = {}
     managers = {}
 
-    # Inicializar usuários
-    port_socket = 8001
-    port_rpc = 9001
-
+    # Inicializar usuários (portas atribuídas dinamicamente)
     for name, (lat, lon, radius) in users_config.items():
         user = User(name, lat, lon, radius)
         users[name] = user
 
         manager = CommunicationManager(user, central_server)
-        manager.start_services(port_socket, port_rpc)
+        manager.start_services()
         managers[name] = manager
 
-        port_socket += 1
-        port_rpc += 1
-
     time.sleep(3)
 
     print("\nUsuários disponíveis:")
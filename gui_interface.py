@@ -41,9 +41,7 @@ class LauncherGUI:
             user = User(name, lat, lon, radius)
             self.users[user.id] = user
             comm_manager = CommunicationManager(user, self.central_server)
-            port_socket = 8001 + len(self.managers)
-            port_rpc = 9001 + len(self.managers)
-            comm_manager.start_services(port_socket, port_rpc)
+            comm_manager.start_services()
             self.managers[user.id] = comm_manager
             self.open_user_window(user)
 
@@ -68,9 +66,7 @@ class LauncherGUI:
                 user = User(name, lat, lon, radius)
                 self.users[user.id] = user
                 comm_manager = CommunicationManager(user, self.central_server)
-                port_socket = 8001 + len(self.managers)
-                port_rpc = 9001 + len(self.managers)
-                comm_manager.start_services(port_socket, port_rpc)
+                comm_manager.start_services()
                 self.managers[user.id] = comm_manager
         time.sleep(2)
         for user in self.users.values():
@@ -88,36 +84,50 @@ class UserChatWindow:
     def __init__(self, parent, user, comm_manager):
         self.current_user = user
         self.comm_manager = comm_manager
-        # Garante que ao abrir, se usuário está online, começa consumir MOM
-        if self.current_user.status == "online" and hasattr(self.comm_manager, "mom_comm"):
-            try:
-                self.comm_manager.mom_comm.start_consuming()
-            except Exception as e:
-                print(f"Erro ao iniciar consumo MOM: {e}")
+        self.contacts_subscribed = False
         self.root = tk.Toplevel(parent)
         self.root.title(f"Chat - {user.name}")
         self.root.geometry("1000x700")
         self.root.configure(bg='#2c3e50')
         self.setup_chat_window()
 
-        # CORREÇÃO PRINCIPAL: Registrar handler para mensagens recebidas
-        self.comm_manager.add_message_handler(self._handle_received_message)
+        # CORREÇÃO PRINCIPAL: Registrar handler para mensagens recebidas.
+        # Cada entrega (inclusive o backlog drenado) é renderizada de uma vez
+        self.comm_manager.add_batch_message_handler(self._handle_received_batch)
 
-    def _handle_received_message(self, sender: str, message: str, msg_type: str):
-        """Handler para processar mensagens recebidas - THREAD SAFE"""
+        # Garante que ao abrir, se usuário está online, começa consumir MOM
+        if self.current_user.status == "online" and hasattr(self.comm_manager, "mom_comm"):
+            self._start_mom_consuming()
 
-        def update_gui():
-            type_map = {
-                'socket': 'received',
-                'rpc': 'received',
-                'async': 'received'
-            }
-            gui_msg_type = type_map.get(msg_type, 'received')
+    def _handle_received_batch(self, messages: list):
+        """Handler para processar lotes de mensagens recebidas - THREAD SAFE"""
+        entries = []
+        for sender, message, msg_type in messages:
             suffix = " (Assíncrona)" if msg_type == 'async' else ""
-            self.add_message_to_chat(f"{message}{suffix}", sender, gui_msg_type)
+            entries.append((f"{message}{suffix}", sender, 'received'))
 
         # Executar na thread da GUI
-        self.root.after(0, update_gui)
+        self.root.after(0, self.add_messages_to_chat, entries)
+
+    def _start_mom_consuming(self):
+        """Drena o backlog da fila MOM como um lote e passa ao consumo contínuo.
+        Roda em thread separada para não congelar a janela durante a drenagem."""
+        def run():
+            try:
+                mom_comm = self.comm_manager.mom_comm
+                mom_comm.start_consuming(drain_backlog=True)
+                stats = mom_comm.last_drain_stats
+                if stats and stats['messages']:
+                    self.root.after(
+                        0, self.add_message_to_chat,
+                        f"{stats['messages']} mensagens pendentes recebidas em "
+                        f"{stats['seconds'] * 1000:.0f} ms ({stats['rate']:.0f} msg/s)",
+                        "Sistema", "system"
+                    )
+            except Exception as e:
+                print(f"Erro ao iniciar consumo MOM: {e}")
+
+        threading.Thread(target=run, daemon=True).start()
 
     def setup_chat_window(self):
         for widget in self.root.winfo_children():
@@ -227,14 +237,16 @@ class UserChatWindow:
                 "sent"
             )
             self.message_entry.delete(0, tk.END)
-            threading.Thread(
-                target=self.comm_manager.send_message,
-                args=(contact['id'], message),
-                daemon=True
-            ).start()
+            self.comm_manager.send_async(contact['id'], message, callback=self._on_delivery_status)
         else:
             messagebox.showerror("Erro", "Contato inválido!")
 
+    def _on_delivery_status(self, target_id, message, status):
+        """Callback de entrega executado no worker de envio - THREAD SAFE"""
+        if status == "failed":
+            self.root.after(0, self.add_message_to_chat,
+                            f"Falha ao entregar: {message}", "Sistema", "error")
+
     def select_contact_for_message(self, event):
         self.message_entry.focus()
 
@@ -286,12 +298,18 @@ Tipo de comunicação: {'Síncrona' if contact['status'] == 'online' and contact
             self.contact_info_label.config(text="Contato inválido")
 
     def add_message_to_chat(self, message, sender="Sistema", msg_type="info"):
+        self.add_messages_to_chat([(message, sender, msg_type)])
+
+    def add_messages_to_chat(self, entries):
+        """Insere várias mensagens (message, sender, msg_type) com uma única atualização da área de chat"""
         # Verificar se a janela ainda existe
         if not self.chat_area.winfo_exists():
             return
 
         # Evitar duplicar mensagens do próprio usuário
-        if msg_type == "received" and sender == self.current_user.name:
+        entries = [(message, sender, msg_type) for message, sender, msg_type in entries
+                   if not (msg_type == "received" and sender == self.current_user.name)]
+        if not entries:
             return
 
         self.chat_area.config(state=tk.NORMAL)
@@ -301,15 +319,16 @@ Tipo de comunicação: {'Síncrona' if contact['status'] == 'online' and contact
             "error": "#e74c3c", "info": "#8e44ad"
         }
         prefix_map = {"sent": "➤", "received": "⬅", "system": "ℹ", "error": "⚠", "info": "📢"}
-        prefix = prefix_map.get(msg_type, "•")
-        color = colors.get(msg_type, "#2c3e50")
-        self.chat_area.insert(tk.END, f"[{timestamp}] ")
-        start_pos = self.chat_area.index(tk.INSERT)
-        self.chat_area.insert(tk.END, f"{prefix} {sender}: {message}\n")
-        end_pos = self.chat_area.index(tk.INSERT)
-        tag_name = f"msg_{msg_type}_{timestamp}_{hash(sender + message)}"
-        self.chat_area.tag_add(tag_name, start_pos, end_pos)
-        self.chat_area.tag_config(tag_name, foreground=color, font=('Consolas', 10, 'bold'))
+        for message, sender, msg_type in entries:
+            prefix = prefix_map.get(msg_type, "•")
+            color = colors.get(msg_type, "#2c3e50")
+            self.chat_area.insert(tk.END, f"[{timestamp}] ")
+            start_pos = self.chat_area.index(tk.INSERT)
+            self.chat_area.insert(tk.END, f"{prefix} {sender}: {message}\n")
+            end_pos = self.chat_area.index(tk.INSERT)
+            tag_name = f"msg_{msg_type}_{timestamp}_{hash(sender + message)}"
+            self.chat_area.tag_add(tag_name, start_pos, end_pos)
+            self.chat_area.tag_config(tag_name, foreground=color, font=('Consolas', 10, 'bold'))
         self.chat_area.config(state=tk.DISABLED)
         self.chat_area.see(tk.END)
 
@@ -372,38 +391,41 @@ Tipo de comunicação: {'Síncrona' if contact['status'] == 'online' and contact
         new_status = "offline" if self.current_user.status == "online" else "online"
         self.current_user.set_status(new_status)
         self.comm_manager.central_server.update_user_status(self.current_user.id, new_status)
-        # >>>> INÍCIO: Reinicia o consumo da fila MOM quando voltar online
-        if new_status == "online":
-            try:
-                if hasattr(self.comm_manager, "mom_comm"):
-                    self.comm_manager.mom_comm.start_consuming()
-            except Exception as e:
-                print(f"Erro ao reiniciar consumo MOM: {e}")
-        # <<<< FIM
         self.setup_chat_window()
         self.add_message_to_chat(
             f"Status alterado para {new_status.upper()}",
             "Sistema",
             "system"
         )
+        # >>>> INÍCIO: Offline, as mensagens ficam na fila MOM; ao voltar
+        # online o backlog é drenado de uma vez antes do consumo contínuo
+        if hasattr(self.comm_manager, "mom_comm"):
+            if new_status == "online":
+                self._start_mom_consuming()
+            else:
+                self.comm_manager.mom_comm.stop_consuming()
+        # <<<< FIM
 
     def start_updates(self):
-        def update_loop():
-            while True:
-                try:
-                    if self.current_user and self.comm_manager and self.root.winfo_exists():
-                        self.root.after(0, self.update_contacts)
-                        self.root.after(0, self.update_contact_info)
-                    else:
-                        break
-                    time.sleep(3)  # Reduzido para 3 segundos para melhor responsividade
-                except Exception as e:
-                    print(f"Erro no loop de atualização: {e}")
-                    break
+        """Atualiza os contatos quando o servidor central notifica mudanças, sem polling"""
+        if not self.contacts_subscribed:
+            self.comm_manager.add_contact_listener(self._on_contact_events)
+            self.contacts_subscribed = True
+        self.update_contacts()
+
+    def _on_contact_events(self, events):
+        """Listener de mudanças nos contatos - THREAD SAFE"""
+        try:
+            self.root.after(0, self._apply_contact_events)
+        except (tk.TclError, RuntimeError):
+            # Janela fechada: não há mais o que atualizar
+            self.comm_manager.remove_contact_listener(self._on_contact_events)
 
-        thread = threading.Thread(target=update_loop, daemon=True)
-        thread.start()
+    def _apply_contact_events(self):
+        if not self.root.winfo_exists():
+            return
         self.update_contacts()
+        self.update_contact_info()
 
 
 class UserCreationDialog:
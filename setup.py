@@ -195,24 +195,23 @@ def verificar_portas():
     """Verifica se as portas necessárias estão disponíveis"""
     print("\n🔌 Verificando disponibilidade de portas...")
 
-    # Portas do RabbitMQ (5672) e aplicação (8001-8004, 9001-9004)
-    portas_app = [8001, 8002, 8003, 8004, 9001, 9002, 9003, 9004]
+    # A aplicação usa portas efêmeras (porta 0) atribuídas pelo sistema e
+    # publicadas no servidor central; só o RabbitMQ (5672) tem porta fixa
     porta_rabbitmq = 5672
 
     import socket
 
-    portas_app_ocupadas = []
-
-    # Verificar portas da aplicação
-    for porta in portas_app:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
-        resultado = sock.connect_ex(('localhost', porta))
+    # Verificar se o sistema consegue atribuir portas efêmeras
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('localhost', 0))
+        porta_efemera = sock.getsockname()[1]
+        portas_efemeras_ok = True
+    except OSError:
+        portas_efemeras_ok = False
+    finally:
         sock.close()
 
-        if resultado == 0:
-            portas_app_ocupadas.append(porta)
-
     # Verificar porta RabbitMQ (deve estar ocupada se funcionando)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(1)
@@ -224,12 +223,12 @@ def verificar_portas():
     else:
         print(f"⚠️ RabbitMQ não está rodando na porta {porta_rabbitmq}")
 
-    if portas_app_ocupadas:
-        print(f"⚠️ Portas da aplicação ocupadas: {portas_app_ocupadas}")
-        print("   Isso pode causar conflitos. Considere parar outros serviços.")
+    if not portas_efemeras_ok:
+        print("⚠️ Não foi possível obter uma porta efêmera em localhost")
+        print("   Verifique o firewall ou use um PortAllocator com um intervalo liberado.")
         return False
     else:
-        print("✅ Todas as portas da aplicação estão disponíveis")
+        print(f"✅ Portas da aplicação atribuídas dinamicamente (ex.: {porta_efemera})")
         return True
 
 